@@ -29,8 +29,7 @@ class AuthController(Controller):
         ]:
             return None
         try:
-            a = cls.auth_service().authentificate_by_request(request)
-            return a
+            return cls.auth_service().authentificate_by_request(request)
         except (NoDataForAuth, IncorrectToken):
             if auto_register:
                 return cls.new_default_account(request, auto_register=auto_register)
@@ -83,7 +82,8 @@ class AuthController(Controller):
             account = cls.auth_service().authentificate_by_request(request)
             if account:
                 request.response.set_cookie(
-                    "token", account.set_new_token() if not request.get("use_prev_token", False) else account.token,
+                    "token",
+                    cls.auth_service().issue_token(account) if not request.get("use_prev_token", False) else account.token,
                     path="/", expires=datetime.now() + timedelta(days=30)
                 )
                 return {"redirect_to": cls.root} if not request.get("use_prev_token", False) else True
@@ -104,6 +104,7 @@ class AuthController(Controller):
         @rtype : bool
 
         """
+        cls.auth_service().logout_token(request.get("token", None))
         request.response.set_cookie("token", "", path="/", expires=datetime.now() - timedelta(seconds=30*60))
         app.redirect(cls.root)
 
@@ -134,6 +135,12 @@ class AuthController(Controller):
             request.get("new_password2")
         )
         if res:
+            if cls.auth_service().token_mode == "signed":
+                # Остальные сессии завершены отзывом токенов, текущая получает новый токен
+                request.response.set_cookie(
+                    "token", cls.auth_service().issue_token(user.account), path="/",
+                    expires=datetime.now() + timedelta(days=30)
+                )
             cls.auth_service().send_sms(
                 user.phone, "%s\nВаш пароль изменен.\nНовый пароль: %s" % (
                     cls.auth_service().smtp_config.sms_sender, request.get("new_password")
@@ -169,7 +176,7 @@ class AuthController(Controller):
             raise AlreadyRegistred()
 
         account = Accounts().get_item({"login": user.account.login})
-        account.login = phone
+        account.rename(phone)
         account.save()
         user.account = account
         user.verification_code = "%d%d%d%d" % (
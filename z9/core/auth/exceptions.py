@@ -36,6 +36,11 @@ class IncorrectToken(CommonException):
     message = "Ошибка аутентификации. Некорректно указан токен."
 
 
+# noinspection PyDocstring
+class ExpiredToken(IncorrectToken):
+    message = "Ошибка аутентификации. Срок действия токена истек."
+
+
 # noinspection PyDocstring
 class NoDataForAuth(CommonException):
     message = "Ошибка аутентификации. Недостаточно данных для аутентификации."
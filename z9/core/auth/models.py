@@ -9,17 +9,20 @@ from datetime import datetime
 import smtplib
 from email.mime.text import MIMEText
 
-from mapex import EntityModel, CollectionModel
 from envi import Request
+from z9.core.models import EntityModel, CollectionModel, Prefetch, get_column_properties, listen_writes
 from z9.core.auth.mappers import AccountsMapper, AccountSettingsMapper
 from z9.core.auth.exceptions import *
-from z9.core.utils import md5, flexdict, flat_dict
-from mapex.Utils import do_dict, merge_dict
+from z9.core.auth.tokens import SignedTokens
+from z9.core.utils import md5, flat_dict, unflat_dict, copy_dict, LRUCache
 
 
 class Accounts(CollectionModel):
-    """ Класс для работы с коллекцией учетных записей """
+    """ Класс для работы с коллекцией учетных записей
+    Настройки загружаются пакетно только по запросу: get_items(..., prefetch_related=[Accounts.settings_prefetch])
+    """
     mapper = AccountsMapper
+    settings_prefetch = Prefetch("settings_raw", lambda: AccountSettings(), via="account")
 
 
 class Account(EntityModel):
@@ -45,23 +48,91 @@ class Account(EntityModel):
         Генерирует новый токен для аккаунта и сохраняет его
         @return: Новый сгенерированный токен аккаунта
         """
+        AuthentificationService.forget_token(self.token)
         # noinspection PyAttributeOutsideInit
         self.token = md5("%s%d" % (str(datetime.now()), random.choice(range(100))))
         self.save()
         return self.token
 
+    # Кэш деревьев настроек по логину (LRUCache); по умолчанию выключен
+    settings_cache = None
+
     @property
     def settings(self):
         if not hasattr(self, "_settings"):
-            self._settings = flexdict()
-            for setting in self.settings_raw:
-                self._settings = merge_dict(self._settings, do_dict(setting.name, setting.value, cls=flexdict), cls=flexdict)
+            cache = self.settings_cache if self.login else None
+            tree = cache.get(self.login) if cache is not None else None
+            if tree is None:
+                tree = unflat_dict((setting.name, setting.value) for setting in self.settings_raw)
+                if cache is not None:
+                    cache.set(self.login, copy_dict(tree))
+            else:
+                tree = copy_dict(tree)
+            self._settings = tree
+            self._settings_owner = self.login
+            self._settings_snapshot = {name: str(value) for name, value in flat_dict(tree).items()}
         return self._settings
 
+    def settings_changes(self) -> tuple:
+        """
+        Возвращает изменения настроек относительно сохраненных в базе данных
+        @return: (добавленные {имя: значение}, измененные {имя: значение}, список имен удаленных)
+        """
+        if not hasattr(self, "_settings"):
+            return {}, {}, []
+        current = {name: str(value) for name, value in flat_dict(self._settings).items()}
+        snapshot = self._settings_snapshot if self._settings_owner == self.login else {}
+        inserted = {name: value for name, value in current.items() if name not in snapshot}
+        updated = {name: value for name, value in current.items() if name in snapshot and snapshot[name] != value}
+        deleted = [name for name in snapshot if name not in current]
+        return inserted, updated, deleted
+
+    def rename(self, login: str):
+        """
+        Меняет логин аккаунта; настройки будут перенесены на новый логин при сохранении
+        @param login: Новый логин
+        """
+        # noinspection PyStatementEffect
+        self.settings
+        # noinspection PyAttributeOutsideInit
+        self.login = login
+
+    def persist(self):
+        result = super().persist()
+        self._save_settings_changes()
+        return result
+
     def save_settings(self):
-        self.mark_as_changed()
         return self.save()
 
+    def _save_settings_changes(self):
+        """ Сохраняет в AccountSettings только добавленные, измененные и удаленные настройки """
+        if not hasattr(self, "_settings"):
+            return
+        inserted, updated, deleted = self.settings_changes()
+        renamed_from = self._settings_owner if self._settings_owner != self.login else None
+        if not (inserted or updated or deleted or renamed_from):
+            return
+
+        if renamed_from:
+            AccountSettings().delete({"account.login": renamed_from})
+        if deleted:
+            AccountSettings().delete({"account.login": self.login, "name": ("in", deleted)})
+        for name, value in updated.items():
+            AccountSettings().update({"value": value}, {"account.login": self.login, "name": name})
+        for name, value in inserted.items():
+            AccountSetting({"account": self, "name": name, "value": value}).save()
+
+        if self.settings_cache is not None:
+            self.settings_cache.invalidate(self.login)
+            self.settings_cache.invalidate(renamed_from)
+        self._settings_owner = self.login
+        self._settings_snapshot = {name: str(value) for name, value in flat_dict(self._settings).items()}
+        if isinstance(self.settings_raw, list):
+            self.settings_raw[:] = [
+                AccountSetting({"name": name, "value": value}) for name, value in self._settings_snapshot.items()
+            ]
+
     def validate(self):
         """
         Валидация сущности учетной записи
@@ -73,9 +144,40 @@ class Account(EntityModel):
         if not self.password_raw or self.password_raw == "d41d8cd98f00b204e9800998ecf8427e":
             raise NoPasswordForAccount()
 
-        self.settings_raw = [
-            AccountSetting({"name": name, "value": str(value)}) for name, value in flat_dict(self.settings).items()
-        ]
+
+class AccountReference(object):
+    """ Аккаунт, аутентифицированный по подписанному токену
+
+    Логин и токен известны без обращения к базе данных,
+    сам аккаунт загружается только при первом обращении к остальным его данным.
+    Там, где нужна сама сущность (например, значение свойства-ссылки), передается account
+
+    """
+    __slots__ = ("login", "token", "_account")
+
+    def __init__(self, login: str, token: str):
+        object.__setattr__(self, "login", login)
+        object.__setattr__(self, "token", token)
+        object.__setattr__(self, "_account", None)
+
+    @property
+    def account(self) -> Account:
+        """
+        Загружает аккаунт из базы данных
+        @raise IncorrectToken: Если аккаунт был удален
+        """
+        if self._account is None:
+            account = Accounts().get_item({"login": self.login})
+            if not account:
+                raise IncorrectToken()
+            object.__setattr__(self, "_account", account)
+        return self._account
+
+    def __getattr__(self, item):
+        return getattr(self.account, item)
+
+    def __setattr__(self, key, value):
+        setattr(self.account, key, value)
 
 
 class AccountSettings(CollectionModel):
@@ -94,6 +196,13 @@ class AuthentificationService(object):
 
     """
     smtp_config = None
+    tokens_cache = LRUCache(maxsize=10000, ttl=60)
+
+    # Режим подписанных токенов: в signed_tokens указывается экземпляр SignedTokens.
+    # Непрозрачные токены из базы данных продолжают приниматься, пока они не истекут
+    token_mode = "opaque"
+    signed_tokens = None
+    revocations_cache = LRUCache(maxsize=10000, ttl=60)
 
     @classmethod
     def authentificate(cls, credentials: tuple=None, token: str=None) -> Account:
@@ -129,16 +238,159 @@ class AuthentificationService(object):
     def authentificate_by_token(cls, token: str) -> Account:
         """
         Выполняет аутентификацию пользователя по переданному токену
+
+        В tokens_cache хранится строка аккаунта (значения колонок таблицы), поэтому при попадании в кэш
+        запрос к базе данных не выполняется, а каждый запрос получает собственный экземпляр аккаунта.
+        Записи кэша сбрасываются при смене токена и при любом сохранении аккаунта через z9 в этом процессе;
+        другие процессы могут принимать смененный токен, пока не истечет время жизни записи (tokens_cache.ttl)
+
         @param token: Токен для авторизации
         @raise IncorrectToken: Если не найдено соответствия по токену
         @return: Аккаунт пользователя
 
         """
-        account_found = Accounts().get_item({"token": token})
-        if account_found:
-            return account_found
-        else:
+        if cls.signed_tokens and SignedTokens.is_signed(token):
+            return cls.authentificate_by_signed_token(token)
+
+        row = cls.tokens_cache.get(token)
+        if row is None:
+            row = next(iter(Accounts().generate_rows(
+                get_column_properties(AccountsMapper), {"token": token}, {"limit": 1}
+            )), None)
+            if row is None:
+                raise IncorrectToken()
+            row = dict(row)
+            cls.tokens_cache.set(token, row, tag=row["login"])
+        return Accounts().from_row(row)
+
+    @classmethod
+    def authentificate_by_signed_token(cls, token: str) -> AccountReference:
+        """
+        Выполняет аутентификацию пользователя по подписанному токену без обращения к базе данных
+        (отметки отзыва токенов аккаунта загружаются одним запросом и кэшируются на revocations_cache.ttl секунд)
+        @param token: Подписанный токен
+        @raise IncorrectToken: Если подпись токена неверна или токен отозван
+        @raise ExpiredToken: Если срок действия токена истек
+        @return: Ссылка на аккаунт пользователя
+        """
+        claims = cls.signed_tokens.verify(token)
+        watermark, logged_out = cls.get_revocations(claims["login"])
+        if claims["issued"] <= watermark or claims["issued"] in logged_out:
             raise IncorrectToken()
+        return AccountReference(claims["login"], token)
+
+    @classmethod
+    def issue_token(cls, account) -> str:
+        """
+        Выпускает новый токен для аккаунта в соответствии с режимом token_mode
+        @param account: Аккаунт пользователя
+        @return: Новый токен
+        """
+        if cls.token_mode == "signed":
+            # Токен, выпущенный в ту же миллисекунду, что и отзыв токенов, не должен считаться отозванным
+            watermark, logged_out = cls.get_revocations(account.login)
+            issued = max(SignedTokens.now(), watermark + 1)
+            while issued in logged_out:
+                issued += 1
+            return cls.signed_tokens.issue(account.login, issued)
+        return account.set_new_token()
+
+    @classmethod
+    def get_revocations(cls, login: str) -> tuple:
+        """
+        Возвращает отметки отзыва подписанных токенов аккаунта: время (в миллисекундах), до которого отозваны все
+        токены, и множество времен выдачи токенов, сессии которых завершены выходом (logout_token).
+        Значения хранятся в настройках аккаунта, читаются без загрузки аккаунта и кэшируются в процессе
+        на revocations_cache.ttl секунд. Токены удаленного аккаунта отклоняются при обращении к его данным
+        (AccountReference.account)
+        @param login: Логин аккаунта
+        @return: (время отзыва всех токенов, frozenset времен выдачи завершенных сессий)
+        """
+        def load():
+            values = {
+                row["name"]: row["value"] for row in AccountSettings().generate_rows(
+                    ["name", "value"], {"account.login": login, "name": ("in", ["auth.tokens_revoked", "auth.logged_out"])}
+                )
+            }
+            return (
+                int(values.get("auth.tokens_revoked") or 0),
+                frozenset(int(issued) for issued in str(values.get("auth.logged_out") or "").split(",") if issued)
+            )
+        return cls.revocations_cache.get_or_set(login, load)
+
+    @classmethod
+    def revoke_tokens(cls, account: Account):
+        """
+        Отзывает все выданные аккаунту токены: подписанные - по отметке времени, непрозрачный - сменой токена
+        @param account: Аккаунт пользователя
+        """
+        watermark = SignedTokens.now()
+        account.settings.auth.tokens_revoked = watermark
+        account.save_settings()
+        cls.revocations_cache.invalidate(account.login)
+        account.set_new_token()
+
+    @classmethod
+    def logout_token(cls, token: str):
+        """
+        Завершает сессию одного токена, не затрагивая остальные сессии аккаунта
+        Непрозрачный токен только удаляется из кэша аутентификации (как и раньше), подписанный - отзывается
+        по времени выдачи; отметки истекших токенов при этом удаляются из настроек аккаунта
+        @param token: Токен текущей сессии
+        """
+        cls.forget_token(token)
+        if not (cls.signed_tokens and SignedTokens.is_signed(token)):
+            return
+        try:
+            claims = cls.signed_tokens.verify(token)
+        except (IncorrectToken, ExpiredToken):
+            return
+        account = Accounts().get_item({"login": claims["login"]})
+        if not account:
+            return
+        horizon = SignedTokens.now() - int(cls.signed_tokens.ttl.total_seconds() * 1000)
+        logged_out = {
+            int(issued) for issued in str(account.settings.get("auth", {}).get("logged_out", "")).split(",")
+            if issued and int(issued) > horizon
+        }
+        logged_out.add(claims["issued"])
+        account.settings.auth.logged_out = ",".join(str(issued) for issued in sorted(logged_out))
+        account.save_settings()
+        cls.revocations_cache.invalidate(account.login)
+
+    @classmethod
+    def rotate_tokens(cls, account: Account):
+        """
+        Завершает сессии аккаунта: в режиме подписанных токенов отзывает все токены, иначе меняет непрозрачный токен
+        @param account: Аккаунт пользователя
+        """
+        if cls.token_mode == "signed":
+            cls.revoke_tokens(account)
+        else:
+            account.set_new_token()
+
+    @classmethod
+    def accounts_written(cls, saved: list, deleted: list, updated: list):
+        """
+        Сбрасывает закэшированные строки аккаунтов после записи через z9 (listen_writes)
+        @param saved: Сохраненные аккаунты
+        @param deleted: Логины удаленных аккаунтов
+        @param updated: Логины аккаунтов, измененных update коллекции
+        """
+        for account in saved:
+            cls.forget_token(account.token)
+            cls.tokens_cache.invalidate_tag(account.login)
+        for login in deleted + updated:
+            cls.tokens_cache.invalidate_tag(login)
+
+    @classmethod
+    def forget_token(cls, token: str):
+        """
+        Удаляет токен из кэша аутентификации, чтобы следующая проверка токена выполнялась по базе данных
+        @param token: Токен для авторизации
+        """
+        if token:
+            cls.tokens_cache.invalidate(token)
 
     @classmethod
     def authentificate_by_credentials(cls, login, password) -> Account:
@@ -170,7 +422,7 @@ class AuthentificationService(object):
         account = Accounts().get_item({"login": login})
         if not account:
             raise IncorrectLogin()
-        account.set_new_token()
+        cls.rotate_tokens(account)
         new_passw = cls.gen_password()
         account.password = new_passw
         account.save()
@@ -192,8 +444,11 @@ class AuthentificationService(object):
             raise IncorrectPassword()
         if new_password != new_password2:
             raise NewPasswordsMismatch()
+        cls.forget_token(account.token)
         account.password = new_password
         account.save()
+        if cls.token_mode == "signed":
+            cls.revoke_tokens(account)
         return True
 
     @classmethod
@@ -242,3 +497,6 @@ class AuthentificationService(object):
         l = [digit1, digit2, upper_char] + chars
         random.shuffle(l)
         return "".join(l)
+
+
+listen_writes(AccountsMapper, "tokens_cache", AuthentificationService.accounts_written)
@@ -2,8 +2,12 @@
 
 """
 
+from datetime import timedelta
+from unittest import TestCase
+
 from z9.core.models import EntityModelTest
-from z9.core.auth.models import Account, Accounts, AuthentificationService, AccountSetting
+from z9.core.auth.models import Account, Accounts, AuthentificationService, AccountSetting, AccountSettings
+from z9.core.auth.tokens import SignedTokens
 from z9.core.auth.exceptions import *
 
 from z9.core.utils import md5
@@ -87,6 +91,64 @@ class AuthentificationServiceTests(EntityModelTest):
         authentificated_account = AuthentificationService().authentificate(token="12345678")
         self.assertTrue(isinstance(authentificated_account, Account))
 
+    def test_rotated_token_is_not_cached(self):
+        """ После смены токена старый токен перестает действовать, даже если он был закэширован """
+        account = Account({"login": "login", "password": "12345", "token": "12345678"}).save()
+        AuthentificationService().authentificate(token="12345678")
+        account.set_new_token()
+        self.assertRaises(IncorrectToken, AuthentificationService().authentificate, token="12345678")
+        self.assertTrue(isinstance(AuthentificationService().authentificate(token=account.token), Account))
+
+    def test_change_password_revokes_signed_tokens(self):
+        """ В режиме подписанных токенов смена пароля отзывает ранее выданные токены """
+        Account({"login": "login", "password": "12345"}).save()
+        token_mode, signed_tokens = AuthentificationService.token_mode, AuthentificationService.signed_tokens
+        AuthentificationService.token_mode = "signed"
+        AuthentificationService.signed_tokens = SignedTokens({"k1": "secret"})
+        try:
+            token = AuthentificationService.signed_tokens.issue("login", issued=SignedTokens.now() - 1000)
+            self.assertEqual("login", AuthentificationService().authentificate(token=token).login)
+            AuthentificationService().change_password("login")
+            self.assertRaises(IncorrectToken, AuthentificationService().authentificate, token=token)
+            new_token = AuthentificationService().issue_token(Accounts().get_item({"login": "login"}))
+            self.assertEqual("login", AuthentificationService().authentificate(token=new_token).login)
+        finally:
+            AuthentificationService.token_mode, AuthentificationService.signed_tokens = token_mode, signed_tokens
+            AuthentificationService.revocations_cache.clear()
+
+    def test_logout_ends_only_current_session(self):
+        """ В режиме подписанных токенов выход завершает только сессию текущего токена """
+        Account({"login": "login", "password": "12345"}).save()
+        token_mode, signed_tokens = AuthentificationService.token_mode, AuthentificationService.signed_tokens
+        AuthentificationService.token_mode = "signed"
+        AuthentificationService.signed_tokens = SignedTokens({"k1": "secret"})
+        try:
+            first = AuthentificationService.signed_tokens.issue("login", issued=SignedTokens.now() - 1000)
+            second = AuthentificationService.signed_tokens.issue("login", issued=SignedTokens.now() - 500)
+            AuthentificationService().logout_token(first)
+            self.assertRaises(IncorrectToken, AuthentificationService().authentificate, token=first)
+            self.assertEqual("login", AuthentificationService().authentificate(token=second).login)
+        finally:
+            AuthentificationService.token_mode, AuthentificationService.signed_tokens = token_mode, signed_tokens
+            AuthentificationService.revocations_cache.clear()
+
+    def test_cached_token_returns_new_instance(self):
+        """ Каждая аутентификация по токену возвращает собственный экземпляр аккаунта """
+        Account({"login": "login", "password": "12345", "token": "12345678"}).save()
+        first = AuthentificationService().authentificate(token="12345678")
+        second = AuthentificationService().authentificate(token="12345678")
+        self.assertEqual("login", AuthentificationService.tokens_cache.get("12345678")["login"])
+        self.assertIsNot(first, second)
+
+    def test_saved_account_is_not_cached(self):
+        """ После сохранения аккаунта закэшированная строка аккаунта не используется """
+        account = Account({"login": "login", "password": "12345", "token": "12345678"}).save()
+        AuthentificationService().authentificate(token="12345678")
+        account.password = "54321"
+        account.save()
+        self.assertIsNone(AuthentificationService.tokens_cache.get("12345678"))
+        self.assertEqual(md5("54321"), AuthentificationService().authentificate(token="12345678").password)
+
     def test_change_password(self):
         """ Сервис аутентификации позволяет менять пароль пользователя """
         account = Account({"login": "login", "password": "12345", "token": "12345678"}).save()
@@ -97,6 +159,42 @@ class AuthentificationServiceTests(EntityModelTest):
         self.assertNotEqual("12345", account.password)
         self.assertEqual(md5(new_password), account.password)
 
+    def tearDown(self):
+        super().tearDown()
+        AuthentificationService.tokens_cache.clear()
+
+
+class SignedTokensTests(TestCase):
+    """ Тестирование подписанных токенов """
+
+    def test_issue_and_verify(self):
+        """ Выпущенный токен проходит проверку и содержит логин аккаунта """
+        tokens = SignedTokens({"k1": "secret"})
+        token = tokens.issue("login")
+        self.assertTrue(SignedTokens.is_signed(token))
+        self.assertFalse(SignedTokens.is_signed("12345678"))
+        self.assertEqual("login", tokens.verify(token)["login"])
+
+    def test_tampered_token(self):
+        """ Токен с измененной подписью или подписанный неизвестным ключом не проходит проверку """
+        token = SignedTokens({"k1": "secret"}).issue("login")
+        self.assertRaises(IncorrectToken, SignedTokens({"k1": "other"}).verify, token)
+        self.assertRaises(IncorrectToken, SignedTokens({"k2": "secret"}).verify, token)
+        self.assertRaises(IncorrectToken, SignedTokens({"k1": "secret"}).verify, token[:-2] + "xx")
+        self.assertRaises(IncorrectToken, SignedTokens({"k1": "secret"}).verify, "garbage.token")
+
+    def test_expired_token(self):
+        """ Токен с истекшим сроком действия не проходит проверку """
+        tokens = SignedTokens({"k1": "secret"}, ttl=timedelta(minutes=1))
+        self.assertRaises(ExpiredToken, tokens.verify, tokens.issue("login", issued=SignedTokens.now() - 120000))
+
+    def test_key_rotation(self):
+        """ После ротации ключа токены, подписанные прежним ключом, продолжают действовать """
+        old_token = SignedTokens({"k1": "secret"}).issue("login")
+        tokens = SignedTokens({"k1": "secret", "k2": "new secret"}, current_key="k2")
+        self.assertEqual("k1", tokens.verify(old_token)["key"])
+        self.assertEqual("k2", tokens.verify(tokens.issue("login"))["key"])
+
 
 class AccountSettingsTests(EntityModelTest):
     model_for_test = AccountSetting
@@ -122,6 +220,25 @@ class AccountSettingsTests(EntityModelTest):
         account = Accounts().get_item({"login": "user"})
         self.assertEqual("1", account.settings.a.b)
 
+    def test_only_changed_settings_are_saved(self):
+        """ При сохранении аккаунта записываются только изменившиеся настройки """
+        account = Account({"login": "user", "password": "123"}).save()
+        account.settings.a = 1
+        account.settings.b.c = 2
+        account.save_settings()
+        self.assertEqual(2, AccountSettings().count())
+        self.assertEqual(({}, {}, []), account.settings_changes())
+
+        del account.settings["a"]
+        account.settings.b.c = 3
+        self.assertEqual(({}, {"b.c": "3"}, ["a"]), account.settings_changes())
+        account.save_settings()
+        self.assertEqual(1, AccountSettings().count())
+
+        account = Accounts().get_item({"login": "user"})
+        self.assertEqual("3", account.settings.b.c)
+        self.assertNotIn("a", account.settings)
+
     def tearDown(self):
         super().tearDown()
         Accounts().delete()
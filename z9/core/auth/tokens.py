@@ -0,0 +1,97 @@
+"""
+Подписанные токены аутентификации
+
+Токен содержит логин аккаунта, время выдачи и идентификатор ключа подписи и заверяется HMAC,
+поэтому его проверка не требует обращения к базе данных
+
+"""
+
+import hmac
+import json
+import time
+import hashlib
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import timedelta
+
+from z9.core.auth.exceptions import IncorrectToken, ExpiredToken
+
+
+class SignedTokens(object):
+    """ Выпуск и проверка подписанных токенов
+
+    Поддерживает ротацию ключей: новые токены подписываются текущим ключом,
+    а проверяются любым из известных ключей. Чтобы отозвать все токены, подписанные ключом,
+    достаточно удалить этот ключ из словаря keys
+
+    @param keys: Словарь ключей подписи {идентификатор ключа: секрет}
+    @param current_key: Идентификатор ключа для подписи новых токенов (по умолчанию - последний в keys)
+    @param ttl: Срок действия токена
+    """
+
+    def __init__(self, keys: dict, current_key: str=None, ttl: timedelta=timedelta(days=30)):
+        if not keys:
+            raise ValueError("At least one signing key is required")
+        self.keys = {key_id: secret.encode() if isinstance(secret, str) else secret for key_id, secret in keys.items()}
+        self.current_key = current_key if current_key is not None else list(keys)[-1]
+        self.ttl = ttl
+
+    @staticmethod
+    def is_signed(token: str) -> bool:
+        """
+        Проверяет, похож ли токен на подписанный (непрозрачные токены из базы данных не содержат точки)
+        @param token: Токен
+        """
+        return isinstance(token, str) and token.count(".") == 1
+
+    @staticmethod
+    def now() -> int:
+        """ Текущее время в миллисекундах """
+        return int(time.time() * 1000)
+
+    def issue(self, login: str, issued: int=None) -> str:
+        """
+        Выпускает новый токен для аккаунта
+        @param login: Логин аккаунта
+        @param issued: Время выдачи в миллисекундах (по умолчанию - текущее)
+        @return: Подписанный токен
+        """
+        payload = self._encode(json.dumps(
+            {"l": login, "i": issued if issued is not None else self.now(), "k": self.current_key},
+            separators=(",", ":")
+        ).encode())
+        return "%s.%s" % (payload, self._encode(self._sign(self.current_key, payload)))
+
+    def verify(self, token: str) -> dict:
+        """
+        Проверяет подпись и срок действия токена
+        @param token: Токен
+        @raise IncorrectToken: Если токен поврежден или подписан неизвестным ключом
+        @raise ExpiredToken: Если срок действия токена истек
+        @return: Содержимое токена {"login": ..., "issued": ..., "key": ...}
+        """
+        try:
+            payload, signature = token.split(".")
+            claims = json.loads(self._decode(payload).decode())
+            login, issued, key_id = claims["l"], int(claims["i"]), claims["k"]
+            valid = key_id in self.keys and hmac.compare_digest(
+                self._decode(signature), self._sign(key_id, payload)
+            )
+        except (ValueError, KeyError, TypeError, AttributeError):
+            raise IncorrectToken()
+
+        if not valid:
+            raise IncorrectToken()
+        if issued + self.ttl.total_seconds() * 1000 < self.now():
+            raise ExpiredToken()
+        return {"login": login, "issued": issued, "key": key_id}
+
+    def _sign(self, key_id: str, payload: str) -> bytes:
+        return hmac.new(self.keys[key_id], payload.encode(), hashlib.sha256).digest()
+
+    @staticmethod
+    def _encode(data: bytes) -> str:
+        return urlsafe_b64encode(data).decode().rstrip("=")
+
+    @staticmethod
+    def _decode(data: str) -> bytes:
+        return urlsafe_b64decode(data + "=" * (-len(data) % 4))
@@ -1,10 +1,36 @@
 #!/usr/bin/env python
+import time
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from distutils.util import strtobool
 from mapex.Adapters import NoTableFound
 from z9.core.models import Contours
-from z9.core.utils import bcolors
+from z9.core.utils import bcolors, get_class, reset_migrations_mapper
 from optparse import OptionParser
 
+
+def migrate_database(number, db, plan, output_lock):
+    """ Применяет миграции одной базы данных в отдельном потоке
+    Сообщения выводятся с префиксом базы данных, ошибка не прерывает миграцию остальных баз данных.
+    Маппер таблицы миграций должен быть сброшен до запуска потоков (reset_migrations_mapper)
+    :return: (номер базы данных, DSN, результат apply_migrations или None, исключение или None, время в секундах)
+    """
+    prefix = "[db%d] " % number
+
+    def log(message):
+        with output_lock:
+            print(prefix + message)
+
+    started = time.time()
+    try:
+        log("DSN: %s" % str(db.dsn))
+        return number, db.dsn, db.migrate(plan=plan, log=log, reset_mapper=False), None, time.time() - started
+    except Exception as err:
+        log("{color}FAILED{end}: {error}".format(color=bcolors.FAIL, end=bcolors.ENDC, error=repr(err)))
+        return number, db.dsn, None, err, time.time() - started
+    finally:
+        db.release()
+
 try:
     from application import application
 except NoTableFound:
@@ -20,6 +46,30 @@ if __name__ == "__main__":
         dest="force",
         help="apply migrations without confirmation"
     )
+    cli.add_option(
+        "-p",
+        "--plan",
+        action="store_true",
+        default=False,
+        dest="plan",
+        help="show pending migrations without applying them"
+    )
+    cli.add_option(
+        "-j",
+        "--jobs",
+        type="int",
+        default=1,
+        dest="jobs",
+        help="migrate up to JOBS databases in parallel without confirmation"
+    )
+    cli.add_option(
+        "-r",
+        "--reindex",
+        action="append",
+        default=[],
+        dest="reindex",
+        help="rebuild search index of TableView class (full path, e.g. z9.apps.app.models.common.UsersTable)"
+    )
     cli.add_option(
         "-c",
         "--contour",
@@ -37,21 +87,52 @@ if __name__ == "__main__":
         exit()
 
     # noinspection PyProtectedMember
-    for db in application._databases:
+    databases = application._databases
+    if options.jobs > 1:
         print("Contour: %s" % options.contour)
-        print("DSN: %s" % str(db.pool._dsn))
-
-        if options.force:
-            confirmation = 'Y'
-        else:
-            confirmation = input('{color}continue migration?{end} {color2}(Y or n){end}'.format(
-                color=bcolors.WARNING,
-                color2=bcolors.OKGREEN,
-                end=bcolors.ENDC)
-            ) or 'Y'
-
-        if strtobool(confirmation):
-            db.migrate()
-        else:
-            print("{color}  .. migration canceled{end}".format(color=bcolors.FAIL, end=bcolors.ENDC))
-        print("\n")
+        started = time.time()
+        output_lock = Lock()
+        reset_migrations_mapper()
+        with ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            results = list(executor.map(
+                lambda args: migrate_database(args[0], args[1], options.plan, output_lock), enumerate(databases, 1)
+            ))
+
+        print("\nSummary:")
+        for number, dsn, result, error, elapsed in results:
+            print("  [db{number}] {status} {dsn} ({elapsed:.3f} sec)".format(
+                number=number, dsn=dsn, elapsed=elapsed,
+                status="{color}FAILED{end}".format(color=bcolors.FAIL, end=bcolors.ENDC) if error else
+                       "{color}OK{end} {count} {verb}".format(
+                           color=bcolors.OKGREEN, end=bcolors.ENDC, count=len(result["pending"]),
+                           verb="pending" if options.plan else "applied"
+                       )
+            ))
+        print("Total: %.3f sec" % (time.time() - started))
+        if any(error for _, _, _, error, _ in results):
+            exit(1)
+    else:
+        for db in databases:
+            print("Contour: %s" % options.contour)
+            print("DSN: %s" % str(db.dsn))
+
+            if options.force or options.plan:
+                confirmation = 'Y'
+            else:
+                confirmation = input('{color}continue migration?{end} {color2}(Y or n){end}'.format(
+                    color=bcolors.WARNING,
+                    color2=bcolors.OKGREEN,
+                    end=bcolors.ENDC)
+                ) or 'Y'
+
+            if strtobool(confirmation):
+                db.migrate(plan=options.plan)
+            else:
+                print("{color}  .. migration canceled{end}".format(color=bcolors.FAIL, end=bcolors.ENDC))
+            print("\n")
+
+    # Заполнение поисковых индексов таблиц
+    for path in options.reindex:
+        table = get_class(path)
+        print("{color}Reindex{end}: {path}".format(color=bcolors.OKGREEN, end=bcolors.ENDC, path=path))
+        print("  .. %d rows indexed" % table.rebuild_search_index())
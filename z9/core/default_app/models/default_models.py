@@ -1,6 +1,6 @@
 
 
-from mapex import EntityModel, CollectionModel
+from z9.core.models import EntityModel, CollectionModel
 from z9.apps.{default}.mappers.common import ExampleMapper
 
 class Examples(CollectionModel):
@@ -23,3 +23,11 @@ class InvalidPhoneNumber(CommonException):
     def __init__(self, number):
         self.message = "Некорректный номер телефона %s" % number if number and len(number) else "Не указан номер телефона"
         super().__init__()
+
+
+class PoolTimeout(Exception):
+    """ Исключение, возникающее, если за отведенное время не удалось получить соединение из пула """
+
+
+class MigrationsLocked(Exception):
+    """ Исключение, возникающее, если за отведенное время не удалось получить блокировку применения миграций """
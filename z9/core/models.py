@@ -1,15 +1,23 @@
 import os
 import re
+import time
+import logging
 import unittest
-from mapex import Pool, SqlMapper, EntityModel, EmbeddedObject, CollectionModel
+import threading
+import weakref
+from contextlib import contextmanager, ExitStack
+from contextvars import ContextVar, copy_context
+from itertools import count
+from collections import defaultdict, deque, OrderedDict
+from mapex import Pool, SqlMapper, EmbeddedObject, EntityModel as MapexEntityModel, CollectionModel as MapexCollectionModel
 from mapex import MySqlClient, MsSqlClient, PgSqlClient, MongoClient
 from envi import Application as EnviApplication, ControllerMethodResponseWithTemplate
 from suit.Suit import Suit, TemplateNotFound
 from inspect import isabstract, isclass
 from enum import Enum
 
-from .utils import get_module_members, apply_migrations
-from .exceptions import InvalidPhoneNumber, CommonException
+from .utils import get_module_members, apply_migrations, LRUCache, Histogram, freeze
+from .exceptions import InvalidPhoneNumber, CommonException, PoolTimeout
 
 
 class Contours(Enum):
@@ -18,6 +26,11 @@ class Contours(Enum):
     UNITTESTS = 0
 
 
+logger = logging.getLogger(__name__)
+
+_contour = ContextVar("z9_contour", default=None)
+
+
 class DbClients(object):
     MYSQL = MySqlClient
     PGSQL = PgSqlClient
@@ -28,9 +41,16 @@ class DbClients(object):
 class Application(EnviApplication):
     """ Стандартное приложение z9 """
     ignored_exceptions = [CommonException]
+    templates_path = "views"
+    templates_cache_size = 512
+    # Откладывать сохранения сущностей z9 до конца обработки запроса (unit_of_work)
+    defer_saves = True
 
-    def __init__(self):
+    def __init__(self, prewarm_templates=False):
         super().__init__()
+        self.templates = LRUCache(self.templates_cache_size)
+        if prewarm_templates:
+            self.prewarm_templates()
         self._databases = []
         self._contour = None
         contour_id = Contours.UNITTESTS
@@ -38,21 +58,80 @@ class Application(EnviApplication):
             with open("contour") as f:
                 contour_id = int(f.readline())
         self.contour = Contours(contour_id)
+        try:
+            from uwsgidecorators import postfork
+            postfork(self.after_fork)
+        except ImportError:
+            pass
 
     def database(self, d):
-        d.switch(self.contour)
+        d.switch(self._contour)
         self._databases.append(d)
 
+    def __call__(self, environ, start_response):
+        # Запрос обрабатывается в собственном контексте, в нем же отдается тело ответа (в том числе потоковое).
+        # Соединения возвращаются в пулы сразу после обработки запроса, чтобы не удерживать их, пока клиент
+        # получает ответ; тело, которое читает базу данных, получит соединение заново и вернет его при close
+        context = copy_context()
+        try:
+            body = context.run(self._respond, environ, start_response)
+        except BaseException:
+            context.run(self._release)
+            raise
+        for db in self._databases:
+            db.release_connections()
+        return ResponseBody(body, context, self._release)
+
+    def _respond(self, environ, start_response):
+        _contour.set(self.request_contour(environ))
+        _identities.set({})
+        if not self.defer_saves:
+            return super().__call__(environ, start_response)
+        with unit_of_work():
+            return super().__call__(environ, start_response)
+
+    def _release(self):
+        for db in self._databases:
+            db.release()
+
+    def after_fork(self):
+        """ Пересоздает пулы соединений баз данных в дочернем процессе
+        Вызывается автоматически после fork воркера uwsgi; без uwsgi смена процесса определяется по PID
+        """
+        for db in self._databases:
+            db.after_fork()
+
     @property
     def contour(self):
-        return self._contour
+        return _contour.get() or self._contour
 
     @contour.setter
     def contour(self, c: Contours):
+        """ Устанавливает контур процесса по умолчанию """
         self._contour = c
         for db in self._databases:
             db.switch(c)
 
+    @staticmethod
+    @contextmanager
+    def using_contour(c: Contours):
+        """ Выполняет блок кода на указанном контуре, не затрагивая другие потоки
+        :param c: Контур
+        """
+        token = _contour.set(c)
+        try:
+            yield
+        finally:
+            _contour.reset(token)
+
+    def request_contour(self, environ: dict):
+        """ Возвращает контур для обработки запроса (None - контур процесса по умолчанию)
+        Переопределяется в приложениях, которые обслуживают несколько контуров одновременно
+        (например, предпросмотр беты по заголовку запроса)
+        :param environ: Окружение WSGI
+        """
+        return None
+
     def start_testing(self):
         self.contour = Contours.UNITTESTS
 
@@ -83,15 +162,427 @@ class Application(EnviApplication):
         """
         # noinspection PyBroadException
         try:
-            return Suit(result.template).execute(result.data)
+            return self.get_template(result.template).execute(result.data)
         except TemplateNotFound:
             return str(result)
 
+    def get_template(self, name: str) -> Suit:
+        """ Возвращает скомпилированный шаблон
+        Шаблоны кэшируются на уровне процесса по имени и времени изменения исходника,
+        поэтому отредактированный шаблон будет скомпилирован заново
+        :param name: Имя шаблона (например, views.login)
+        """
+        key = (name, self._get_template_mtime(name))
+        return self.templates.get_or_set(key, lambda: Suit(name))
+
+    @staticmethod
+    def _get_template_mtime(name: str):
+        """ Возвращает время изменения исходника шаблона или None, если исходник не найден
+        :param name: Имя шаблона
+        """
+        try:
+            return os.path.getmtime("%s.html" % name.replace(".", os.sep))
+        except OSError:
+            return None
+
+    def prewarm_templates(self, path: str=None) -> int:
+        """ Заранее компилирует и кэширует все шаблоны из каталога views
+        :param path: Каталог с шаблонами (по умолчанию templates_path)
+        :return: Количество закэшированных шаблонов
+        """
+        path = path or self.templates_path
+        compiled = 0
+        for root, dirs, files in os.walk(path):
+            # Служебные каталоги suitup (__py__, __css__, __js__) шаблонов не содержат
+            dirs[:] = [d for d in dirs if not d.startswith("__")]
+            for file in filter(lambda f: f.endswith(".html"), files):
+                name = os.path.splitext(os.path.relpath(os.path.join(root, file)))[0].replace(os.sep, ".")
+                try:
+                    self.get_template(name)
+                    compiled += 1
+                except TemplateNotFound:
+                    pass
+        return compiled
+
+
+class ResponseBody(object):
+    """ Тело ответа WSGI, которое отдается в контексте обработки запроса
+    :param body: Тело ответа приложения (итерируемый объект)
+    :param context: Контекст обработки запроса
+    :param on_close: Функция, вызываемая после отдачи тела ответа (close)
+    """
+
+    def __init__(self, body, context, on_close):
+        self.body = body
+        self.context = context
+        self.on_close = on_close
+
+    def __iter__(self):
+        iterator = self.context.run(iter, self.body)
+        while True:
+            try:
+                chunk = self.context.run(next, iterator)
+            except StopIteration:
+                return
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, "close", None)
+            if close:
+                self.context.run(close)
+        finally:
+            self.context.run(self.on_close)
+
+
+class ConnectionPool(object):
+    """ Пул соединений с ограничением размера, очередью ожидания и закрытием простаивающих соединений
+    Каждое соединение - это пул mapex из одного соединения. Соединение выдается потоку при первом обращении к db
+    и остается закрепленным за ним (в том числе на время транзакции) до вызова release(): приложение возвращает
+    соединения после обработки запроса и повторно - после отдачи тела ответа (если тело обращалось к базе данных).
+    Поэтому одновременно занято не больше соединений, чем потоков, работающих с базой данных: max_size + overflow
+    должно быть не меньше количества потоков воркера (uwsgi threads), иначе потоки ждут соединения и получают PoolTimeout.
+    Соединение проверяется validation_query перед выдачей, только если оно простаивало дольше validation_interval секунд
+    :param factory: Функция, создающая новое соединение
+    :param min_size: Количество соединений, которые не закрываются при простое
+    :param max_size: Количество постоянно удерживаемых соединений
+    :param overflow: Количество дополнительных соединений сверх max_size, которые закрываются сразу после возврата
+    :param idle_timeout: Время простоя в секундах, после которого соединение закрывается
+    :param checkout_timeout: Максимальное время ожидания свободного соединения в секундах
+    """
+    validation_query = "SELECT 1"
+    validation_interval = 30
+
+    def __init__(self, factory, min_size: int=1, max_size: int=10, overflow: int=0,
+                 idle_timeout: float=300, checkout_timeout: float=30):
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.overflow = overflow
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.size = 0
+        self.checkouts = 0
+        self.timeouts = 0
+        self.created = 0
+        self.closed = 0
+        self.wait_time = Histogram()
+        self._idle = deque()
+        self._orphans = deque()
+        self._available = threading.Condition(threading.Lock())
+        self._bound = threading.local()
+
+    @property
+    def db(self):
+        """ Соединение с базой данных, закрепленное за текущим потоком
+        Если поток завершится без release(), соединение вернется в пул при уничтожении данных потока
+        """
+        bound = getattr(self._bound, "checkout", None)
+        if bound is None:
+            bound = self._bound.checkout = _BoundCheckout(self, self.checkout())
+        return bound.connection.db
+
+    def release(self):
+        """ Возвращает в пул соединение, закрепленное за текущим потоком """
+        bound = getattr(self._bound, "checkout", None)
+        if bound is not None:
+            self._bound.checkout = None
+            bound.finalizer.detach()
+            self.checkin(bound.connection)
+
+    def _orphan(self, connection):
+        """ Принимает соединение завершившегося потока (вызывается сборщиком мусора в произвольном потоке,
+        поэтому блокировка пула не ожидается: соединение будет возвращено при следующем обращении к пулу)
+        """
+        self._orphans.append(connection)
+        if self._available.acquire(blocking=False):
+            try:
+                self._reap()
+                self._available.notify()
+            finally:
+                self._available.release()
+
+    def checkout(self):
+        """ Выдает свободное соединение, при необходимости создает новое или ждет возврата занятого
+        :raise PoolTimeout: Если свободное соединение не появилось за checkout_timeout секунд
+        """
+        started = time.monotonic()
+        deadline = started + self.checkout_timeout
+        while True:
+            with self._available:
+                self._reap()
+                while not self._idle and self.size >= self.max_size + self.overflow:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._available.wait(remaining):
+                        self.timeouts += 1
+                        self.wait_time.observe(time.monotonic() - started)
+                        raise PoolTimeout()
+                    self._reap()
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                else:
+                    connection = None
+                    self.size += 1
+
+            if connection is None:
+                try:
+                    connection = self.factory()
+                except BaseException:
+                    self._discard()
+                    raise
+                self.created += 1
+            elif time.monotonic() - idle_since > self.validation_interval and not self._validate(connection):
+                self._discard(connection)
+                continue
+            self.checkouts += 1
+            self.wait_time.observe(time.monotonic() - started)
+            return connection
+
+    def checkin(self, connection):
+        """ Возвращает соединение в пул; соединения сверх max_size закрываются сразу
+        :param connection: Соединение
+        """
+        with self._available:
+            if self.size > self.max_size:
+                self.size -= 1
+                self._close(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._available.notify()
+
+    def clear(self):
+        """ Закрывает все свободные соединения """
+        with self._available:
+            while self._idle:
+                self.size -= 1
+                self._close(self._idle.popleft()[0])
+            self._available.notify_all()
+
+    @property
+    def in_use(self) -> int:
+        """ Количество выданных соединений """
+        return self.size - len(self._idle)
+
+    def stats(self) -> dict:
+        """ Возвращает статистику пула: счетчики, занятые и свободные соединения, время ожидания соединения """
+        with self._available:
+            idle = len(self._idle)
+            return {
+                "size": self.size,
+                "in_use": self.size - idle,
+                "idle": idle,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "closed": self.closed,
+                "wait_time": self.wait_time.as_dict()
+            }
+
+    def reset_stats(self):
+        """ Сбрасывает счетчики пула """
+        with self._available:
+            self.checkouts = self.timeouts = self.created = self.closed = 0
+            self.wait_time.reset()
+
+    def _reap(self):
+        """ Возвращает в пул соединения завершившихся потоков
+        и закрывает соединения, простаивающие дольше idle_timeout (сверх min_size)
+        """
+        while self._orphans:
+            connection = self._orphans.popleft()
+            if self.size > self.max_size:
+                self.size -= 1
+                self._close(connection)
+            else:
+                self._idle.append((connection, time.monotonic()))
+        expired = time.monotonic() - self.idle_timeout
+        while self._idle and self.size > self.min_size and self._idle[0][1] < expired:
+            self.size -= 1
+            self._close(self._idle.popleft()[0])
+
+    def _validate(self, connection) -> bool:
+        try:
+            connection.db.execute_raw(self.validation_query)
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection=None):
+        with self._available:
+            self.size -= 1
+            self._available.notify()
+        if connection is not None:
+            self._close(connection)
+
+    def _close(self, connection):
+        self.closed += 1
+        close = getattr(connection, "close", None)
+        if close:
+            try:
+                close()
+            except Exception:
+                pass
+
+
+class _BoundCheckout(object):
+    """ Соединение, закрепленное за потоком; при уничтожении без release() соединение возвращается в пул """
+    __slots__ = ("connection", "finalizer", "__weakref__")
+
+    def __init__(self, pool: ConnectionPool, connection):
+        self.connection = connection
+        self.finalizer = weakref.finalize(self, pool._orphan, connection)
+
+
+class BoundPool(object):
+    """ Пул соединений маппера, который определяется привязкой в текущем контексте выполнения (bind_pool)
+    :param mapper: Маппер
+    """
+    __slots__ = ("mapper",)
+
+    def __init__(self, mapper=None):
+        self.mapper = mapper
+
+    def primary(self):
+        """ Пул, на котором выполняются запись и транзакции """
+        pool = bound_pool(self.mapper)
+        if pool is None:
+            raise RuntimeError("No pool is bound for %s" % get_mapper_class(self.mapper).__name__)
+        return pool
+
+    @property
+    def db(self):
+        return self.primary().db
+
+    def __getattr__(self, name):
+        return getattr(self.primary(), name)
+
+
+class DatabasePool(BoundPool):
+    """ Пул соединений базы данных, который присваивается мапперу
+    Реальный пул (Database.pool) определяется при каждом обращении, поэтому смена контура,
+    пересоздание пула после fork и ленивое создание пула не требуют перенастройки мапперов.
+    Пул, привязанный к мапперу через bind_pool, имеет приоритет. Запросы маппера учитываются в статистике базы данных
+    :param database: База данных
+    :param mapper: Маппер
+    """
+    __slots__ = ("database",)
+
+    def __init__(self, database: "Database", mapper=None):
+        super().__init__(mapper)
+        self.database = database
+
+    def primary(self):
+        return bound_pool(self.mapper) or self.database.pool
+
+    @property
+    def db(self):
+        if not self.mapper:
+            return self.primary().db
+        return InstrumentedConnection(self)
+
+    def connection(self, write: bool):
+        """ Соединение текущего потока для чтения (реплика, если возможно) или записи (основной сервер)
+        :param write: Запрос изменяет данные
+        """
+        return (bound_pool(self.mapper) or self.database.route(write)).db
+
+    def release(self):
+        """ Возвращает в пулы соединения текущего потока """
+        self.database.release()
+
+
+_read_verbs = {"SELECT", "SHOW", "DESCRIBE", "DESC", "EXPLAIN"}
+_read_methods = {"select", "count", "get", "fetch", "show", "describe", "exists", "find"}
+_write_methods = {"insert", "update", "delete", "replace", "create", "drop", "alter", "truncate", "upsert"}
+
+
+def is_write_query(method: str, args: tuple=()) -> bool:
+    """ Изменяет ли данные вызов метода соединения
+    Для выполнения произвольного SQL (первый аргумент - строка запроса) вид запроса определяется по команде,
+    для остальных методов - по имени. Неизвестные вызовы и управление транзакциями считаются записью
+    :param method: Имя метода соединения
+    :param args: Аргументы вызова
+    """
+    words = set(method.lower().split("_"))
+    if words & _write_methods:
+        return True
+    if words & _read_methods:
+        return False
+    if args and isinstance(args[0], str) and words & {"execute", "raw", "query"}:
+        sql = args[0].strip().upper()
+        return not sql or sql.split(None, 1)[0] not in _read_verbs or "FOR UPDATE" in sql
+    return True
+
+
+class InstrumentedConnection(object):
+    """ Соединение маппера: направляет каждый запрос на основной сервер (запись) или реплику (чтение)
+    и замеряет длительность выполнения запросов. Запись сбрасывает кэши выборок и карту загруженных сущностей маппера.
+    Соединение выбирается после определения вида запроса, поэтому запись не занимает соединение с репликой
+    :param pool: Пул маппера
+    """
+    __slots__ = ("_pool",)
+    # Является ли атрибут соединения методом: {(адаптер, имя атрибута): bool}
+    _methods = {}
+
+    def __init__(self, pool: DatabasePool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        key = (self._pool.database.adapter, name)
+        if name.startswith("_") or not self._methods.get(key, True):
+            return getattr(self._pool.connection(False), name)
+        if key not in self._methods:
+            # Вид атрибута определяется по соединению один раз для адаптера базы данных
+            attr = getattr(self._pool.connection(False), name)
+            self._methods[key] = callable(attr)
+            if not self._methods[key]:
+                return attr
+
+        def routed(*args, **kwargs):
+            database, mapper = self._pool.database, self._pool.mapper
+            write = is_write_query(name, args)
+            # Любой запрос (в том числе чтение) видит сохранения, отложенные unit_of_work
+            flush()
+            if write:
+                database.invalidate(mapper)
+                forget_identities(mapper)
+            method = getattr(self._pool.connection(write), name)
+            started = time.monotonic()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                database.query_stats(mapper).observe(time.monotonic() - started)
+                if write:
+                    # Пока запрос выполнялся (или до фиксации транзакции) другие потоки могли закэшировать старые данные
+                    database.invalidate(mapper)
+                    invalidate_after_transaction(database, mapper)
+        return routed
+
 
 class Database(object):
+    """ База данных приложения
+    Пулы соединений создаются лениво при первом обращении, отдельно для каждого контура,
+    и пересоздаются в дочернем процессе после fork (uwsgi), чтобы процессы не делили одни и те же сокеты.
+
+    Для контура можно указать основной сервер и реплики: {"primary": (...), "replicas": [(...), ...]}.
+    Чтения коллекций z9 (get_items, get_item, count, generate_rows) выполняются на реплике, выбранной
+    на время запроса (по кругу или наименее загруженной). Остальные запросы и все запросы в транзакции
+    выполняются на основном сервере, после чего до конца запроса на него направляются и чтения
+    """
+    replica_strategies = ("round_robin", "least_loaded")
+    query_cache_size = 1000
+    query_cache_ttl = 60
+
     def __init__(self, adapter, mappers_modules_paths: list, connection_tuples_map: dict,
-                 min_connections=10,
-                 migrations_path=None):
+                 min_connections=1,
+                 migrations_path=None,
+                 max_connections=10,
+                 max_overflow=0,
+                 idle_timeout=300,
+                 checkout_timeout=30,
+                 replica_strategy="round_robin"):
+        if replica_strategy not in self.replica_strategies:
+            raise ValueError("Unknown replica strategy: %s" % replica_strategy)
         self.adapter = adapter
         self._migrations_path = migrations_path
         # noinspection PyDictCreation
@@ -100,23 +591,200 @@ class Database(object):
         self.map[Contours.BETA] = connection_tuples_map.get(Contours.BETA)
         self.map[Contours.UNITTESTS] = connection_tuples_map.get(Contours.UNITTESTS)
 
-        self.pool = None
-        self.contour = None
+        self._contour = Contours.UNITTESTS
+        self.replica_strategy = replica_strategy
+        self._query_stats = defaultdict(Histogram)
+        self._caches = {}
+        self._invalidates = {}
         self._min_connections = min_connections
+        self._max_connections = max_connections
+        self._max_overflow = max_overflow
+        self._idle_timeout = idle_timeout
+        self._checkout_timeout = checkout_timeout
+        self._pools = {}
+        self._inherited_pools = []
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._round_robin = count()
+        self._routing = ContextVar("z9_database_routing_%d" % id(self), default=None)
 
-        self.init_pool(Contours.UNITTESTS)
         self.mappers = []
         for path in mappers_modules_paths:
             self.register_module(path)
 
+    @property
+    def contour(self) -> Contours:
+        """ Контур текущего контекста выполнения (Application.using_contour) или контур по умолчанию """
+        return _contour.get() or self._contour
+
+    @contour.setter
+    def contour(self, c: Contours):
+        self._contour = c
+
+    def dsns(self, c: Contours) -> list:
+        """ Параметры подключения контура: основной сервер, затем реплики
+        :param c: Контур
+        """
+        config = self.map.get(c)
+        if isinstance(config, dict):
+            return [config.get("primary")] + list(config.get("replicas", []))
+        return [config]
+
+    @property
+    def dsn(self):
+        """ Параметры подключения к основному серверу текущего контура """
+        return self.dsns(self.contour)[0]
+
+    @property
+    def pool(self) -> ConnectionPool:
+        """ Пул соединений основного сервера текущего контура (создается при первом обращении) """
+        return self.get_pool(self.contour)
+
+    def get_pool(self, c: Contours, replica: int=0) -> ConnectionPool:
+        """ Возвращает пул соединений контура (создается при первом обращении)
+        :param c: Контур
+        :param replica: Номер сервера в списке dsns (0 - основной сервер)
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        key = (c, replica)
+        pool = self._pools.get(key)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(key)
+                if pool is None:
+                    pool = self._pools[key] = self.create_pool(c, replica)
+        return pool
+
+    def create_pool(self, c: Contours, replica: int=0) -> ConnectionPool:
+        """ Создает пул соединений
+        :param c: Контур
+        :param replica: Номер сервера в списке dsns (0 - основной сервер)
+        """
+        dsn = self.dsns(c)[replica]
+        return ConnectionPool(
+            lambda: Pool(self.adapter, dsn, min_connections=1),
+            min_size=self._min_connections,
+            max_size=self._max_connections,
+            overflow=self._max_overflow,
+            idle_timeout=self._idle_timeout,
+            checkout_timeout=self._checkout_timeout
+        )
+
+    def route(self, write: bool=True) -> ConnectionPool:
+        """ Возвращает пул, на котором нужно выполнить очередной запрос
+        После первой записи все запросы до конца запроса пользователя (release) выполняются на основном сервере
+        :param write: Запрос изменяет данные
+        """
+        dsns = self.dsns(self.contour)
+        if len(dsns) == 1:
+            return self.pool
+        routing = self._routing.get()
+        if routing is None:
+            routing = {"primary": False, "replica": None}
+            self._routing.set(routing)
+        if write:
+            routing["primary"] = True
+        if routing["primary"] or in_transaction():
+            return self.pool
+        if routing["replica"] is None:
+            routing["replica"] = self.choose_replica(len(dsns) - 1)
+        return self.get_pool(self.contour, routing["replica"])
+
+    def choose_replica(self, replicas: int) -> int:
+        """ Выбирает реплику для запроса
+        :param replicas: Количество реплик
+        :return: Номер сервера в списке dsns
+        """
+        if self.replica_strategy == "least_loaded":
+            return min(range(1, replicas + 1), key=lambda n: self.get_pool(self.contour, n).in_use)
+        return next(self._round_robin) % replicas + 1
+
+    def release(self):
+        """ Возвращает в пулы соединения, закрепленные за текущим потоком, и завершает привязку к серверу """
+        self.release_connections()
+        self._routing.set(None)
+
+    def release_connections(self):
+        """ Возвращает в пулы соединения, закрепленные за текущим потоком; привязка запроса к серверу сохраняется """
+        for pool in list(self._pools.values()):
+            pool.release()
+
+    def after_fork(self):
+        """ Сбрасывает пулы, унаследованные от родительского процесса
+        Соединения родителя не закрываются (они продолжают использоваться в нем): ссылки на унаследованные пулы
+        сохраняются до завершения процесса, чтобы деструкторы соединений не отправили серверу QUIT от имени
+        родителя. Новые пулы будут созданы при первом обращении
+        """
+        self._inherited_pools.extend(self._pools.values())
+        self._pools = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
     def init_pool(self, c: Contours):
-        if self.contour != c:
-            self.pool = Pool(self.adapter, self.map.get(c), min_connections=self._min_connections)
-            self.contour = c
+        self._contour = c
+
+    def query_stats(self, mapper) -> Histogram:
+        """ Возвращает гистограмму длительностей запросов маппера
+        :param mapper: Маппер
+        """
+        return self._query_stats[get_mapper_class(mapper).__name__]
+
+    def stats(self) -> dict:
+        """ Возвращает статистику пулов соединений (по контурам) и запросов (по мапперам) """
+        return {
+            "pools": {
+                c.name if not replica else "%s.replica%d" % (c.name, replica): pool.stats()
+                for (c, replica), pool in list(self._pools.items())
+            },
+            "queries": {name: histogram.as_dict() for name, histogram in list(self._query_stats.items())},
+            "caches": {mapper.__name__: cache.stats() for mapper, cache in list(self._caches.items())}
+        }
+
+    def reset_stats(self):
+        """ Сбрасывает статистику пулов соединений и запросов """
+        for pool in list(self._pools.values()):
+            pool.reset_stats()
+        for histogram in list(self._query_stats.values()):
+            histogram.reset()
+        for cache in list(self._caches.values()):
+            cache.reset_stats()
+
+    def register_mapper(self, mapper: SqlMapper, cache=None):
+        """ Регистрирует маппер в базе данных
+        :param mapper: Маппер
+        :param cache: Кэшировать ли результаты выборок коллекций маппера (True или экземпляр LRUCache)
+        """
+        mapper.pool = DatabasePool(self, mapper)
+        self.query_stats(mapper)
+        if cache:
+            self._caches[get_mapper_class(mapper)] = cache if isinstance(cache, LRUCache) else LRUCache(
+                self.query_cache_size, self.query_cache_ttl
+            )
+            self._invalidates.clear()
+        if mapper not in self.mappers:
+            self.mappers.append(mapper)
+
+    def query_cache(self, mapper):
+        """ Возвращает кэш выборок маппера или None, если кэширование для маппера не включено
+        :param mapper: Класс или экземпляр маппера
+        """
+        return self._caches.get(get_mapper_class(mapper)) if self._caches else None
 
-    def register_mapper(self, mapper: SqlMapper):
-        mapper.pool = self.pool
-        self.mappers.append(mapper)
+    def invalidate(self, mapper):
+        """ Сбрасывает кэши выборок маппера и связанных с ним мапперов (зависимостей и зависящих от него)
+        :param mapper: Класс или экземпляр маппера
+        """
+        if not self._caches:
+            return
+        mapper = get_mapper_class(mapper)
+        caches = self._invalidates.get(mapper)
+        if caches is None:
+            related = {mapper} | set(getattr(mapper, "dependencies", []))
+            related |= {m for m in self._caches if mapper in getattr(m, "dependencies", [])}
+            caches = self._invalidates[mapper] = [self._caches[m] for m in related if m in self._caches]
+        for cache in caches:
+            cache.clear()
 
     def register_module(self, *args):
         for mapper in get_module_members(
@@ -125,12 +793,537 @@ class Database(object):
             self.register_mapper(mapper)
 
     def switch(self, c: Contours):
+        """ Устанавливает контур по умолчанию; для отдельного запроса используется Application.using_contour
+        :param c: Контур
+        """
         self.init_pool(c)
-        for mapper in self.mappers:
-            mapper.pool = self.pool
 
-    def migrate(self):
-        apply_migrations(self._migrations_path, self.pool)
+    def migrate(self, plan=False, log=print, reset_mapper=True) -> dict:
+        """ Применяет миграции базы данных текущего контура
+        :param plan: Только вывести список миграций, которые будут применены
+        :param log: Функция вывода сообщений
+        :param reset_mapper: Сбросить маппер таблицы миграций (см. apply_migrations)
+        """
+        return apply_migrations(self._migrations_path, self.pool, plan, log, reset_mapper)
+
+
+_transactions = threading.local()
+_bound_pools = ContextVar("z9_bound_pools", default={})
+
+
+@contextmanager
+def bind_pool(mapper, pool):
+    """ Привязывает маппер к пулу соединений в текущем контексте выполнения (поток, запрос)
+    Остальные потоки продолжают работать с пулом маппера по умолчанию
+    :param mapper: Класс или экземпляр маппера
+    :param pool: Пул соединений
+    """
+    pools = dict(_bound_pools.get())
+    pools[get_mapper_class(mapper)] = pool
+    token = _bound_pools.set(pools)
+    try:
+        yield pool
+    finally:
+        _bound_pools.reset(token)
+
+
+def bound_pool(mapper):
+    """ Возвращает пул, привязанный к мапперу в текущем контексте выполнения, или None
+    :param mapper: Класс или экземпляр маппера
+    """
+    pools = _bound_pools.get()
+    return pools.get(get_mapper_class(mapper)) if pools and mapper is not None else None
+
+
+def in_transaction() -> bool:
+    """ Выполняется ли текущий поток внутри транзакции """
+    return any(getattr(_transactions, "depth", {}).values())
+
+
+_identities = ContextVar("z9_identity_map", default=None)
+
+
+@contextmanager
+def identity_map():
+    """ Включает карту загруженных сущностей на время выполнения блока (Application включает её на время запроса)
+    Повторная загрузка сущности по первичному ключу через get_item возвращает уже загруженный экземпляр без запроса
+    """
+    token = _identities.set({})
+    try:
+        yield
+    finally:
+        _identities.reset(token)
+
+
+def forget_identities(mapper):
+    """ Удаляет из карты загруженных сущностей все сущности маппера текущего контура (после записи через маппер)
+    :param mapper: Класс или экземпляр маппера
+    """
+    identities = _identities.get()
+    if identities:
+        identities.pop(identity_map_key(mapper), None)
+
+
+def identity_map_key(mapper) -> tuple:
+    """ Раздел карты загруженных сущностей: сущности одного маппера на разных контурах хранятся раздельно
+    :param mapper: Класс или экземпляр маппера
+    """
+    return get_contour(mapper), get_mapper_class(mapper)
+
+
+@contextmanager
+def transaction(pool):
+    """ Выполняет блок кода в одной транзакции на соединении пула
+    Вложенные блоки выполняются в рамках внешней транзакции
+    :param pool: Пул соединений (например, mapper.pool)
+    """
+    depth = getattr(_transactions, "depth", {})
+    _transactions.depth = depth
+    if isinstance(pool, BoundPool):
+        pool = pool.primary()
+    key = id(pool)
+    if depth.get(key):
+        depth[key] += 1
+        try:
+            yield
+        finally:
+            depth[key] -= 1
+        return
+
+    depth[key] = 1
+    pool.db.execute_raw("START TRANSACTION")
+    try:
+        yield
+    except BaseException:
+        pool.db.execute_raw("ROLLBACK")
+        raise
+    else:
+        pool.db.execute_raw("COMMIT")
+    finally:
+        del depth[key]
+        if not any(depth.values()):
+            for database, mapper in getattr(_transactions, "invalidates", {}).values():
+                database.invalidate(mapper)
+            _transactions.invalidates = {}
+
+
+def invalidate_after_transaction(database: "Database", mapper):
+    """ Откладывает сброс кэшей выборок маппера до завершения транзакции потока (если она выполняется)
+    :param database: База данных
+    :param mapper: Класс или экземпляр маппера
+    """
+    if in_transaction():
+        invalidates = getattr(_transactions, "invalidates", None)
+        if invalidates is None:
+            invalidates = _transactions.invalidates = {}
+        invalidates[(id(database), get_mapper_class(mapper))] = (database, mapper)
+
+
+def get_mapper_class(mapper) -> type:
+    """ Возвращает класс маппера (модели хранят как класс маппера, так и его экземпляр)
+    :param mapper: Класс или экземпляр маппера
+    """
+    return mapper if isclass(mapper) else type(mapper)
+
+
+def get_contour(mapper):
+    """ Возвращает контур базы данных маппера в текущем контексте выполнения
+    (используется в ключах кэшей, общих для всех контуров процесса)
+    :param mapper: Класс или экземпляр маппера
+    """
+    pool = getattr(mapper, "pool", None)
+    return pool.database.contour if isinstance(pool, DatabasePool) else _contour.get()
+
+
+def get_column_name(mapper, prop: str):
+    """ Возвращает имя колонки таблицы маппера, в которой хранится свойство (для ссылок - колонка внешнего ключа)
+    :param mapper: Класс или экземпляр маппера
+    :param prop: Имя свойства
+    :return: Имя колонки или None, если у свойства нет собственной колонки (встроенные списки, обратные связи)
+    """
+    if prop not in mapper.get_properties():
+        return None
+    return getattr(mapper.get_property(prop), "db_name", None) or None
+
+
+def is_link_property(mapper, prop: str) -> bool:
+    """ Проверяет по описанию поля маппера, является ли свойство ссылкой на сущность (link(..., collection=...))
+    Значение свойства при этом не читается, поэтому связанная сущность не загружается
+    :param mapper: Класс или экземпляр маппера
+    :param prop: Имя свойства
+    """
+    return prop in mapper.get_properties() and getattr(mapper.get_property(prop), "collection", None) is not None
+
+
+def get_table_name(mapper) -> str:
+    """ Возвращает имя таблицы маппера (задается в bind маппера через set_collection_name)
+    :param mapper: Экземпляр маппера
+    :raise ValueError: Если имя таблицы маппера не задано
+    """
+    name = mapper.get_collection_name()
+    if not name:
+        raise ValueError("Mapper %s has no collection name" % get_mapper_class(mapper).__name__)
+    return name
+
+
+def get_column_properties(mapper) -> list:
+    """ Возвращает свойства маппера, хранящиеся в колонках его таблицы (без встроенных списков и обратных связей)
+    :param mapper: Класс или экземпляр маппера
+    """
+    return [prop for prop in mapper.get_properties() if get_column_name(mapper, prop)]
+
+
+def get_link_keys(items: list, prop: str, chunk_size: int=1000) -> list:
+    """ Возвращает значения внешнего ключа свойства-ссылки для списка сущностей
+    Ключи читаются из строк таблицы одним запросом (на каждые chunk_size сущностей), связанные сущности не загружаются
+    :param items: Список сущностей одного маппера
+    :param prop: Имя свойства-ссылки (link)
+    :param chunk_size: Максимальное количество ключей в одном запросе
+    """
+    if not items:
+        return []
+    mapper = items[0].mapper
+    primary = mapper.primary.name()
+    keys = [item.primary.get_value(deep=True) for item in items]
+    links = {}
+    for i in range(0, len(keys), chunk_size):
+        for row in mapper.generate_rows([primary, prop], {primary: ("in", keys[i:i + chunk_size])}, None):
+            links[row[primary]] = row[prop]
+    return [links.get(key) for key in keys]
+
+
+class Prefetch(object):
+    """ Описание связи для пакетной загрузки связанных сущностей целой страницы результатов
+    Вместо загрузки связи для каждой сущности по отдельности выполняется один запрос IN (...) на всю страницу
+    :param prop: Имя заполняемого свойства сущности
+    :param collection: Класс коллекции связанных сущностей (или лямбда, возвращающая экземпляр коллекции)
+    :param via: Для обратных связей (например, embedded_list) - имя свойства-ссылки связанной сущности
+    """
+    chunk_size = 1000
+
+    def __init__(self, prop: str, collection, via: str=None):
+        self.prop = prop
+        self.collection = collection
+        self.via = via
+
+    def apply(self, items: list, rows: list=None):
+        """ Загружает связанные сущности для всех переданных сущностей
+        :param items: Список сущностей
+        :param rows: Строки выборки этих сущностей (значения колонок, в том числе внешних ключей);
+        без них внешние ключи прямых связей читаются отдельным запросом (get_link_keys)
+        """
+        if not items:
+            return
+        if self.via:
+            keys = [item.primary.get_value(deep=True) for item in items]
+            related = defaultdict(list)
+            for key, entity in self._fetch_rows(self.via, keys):
+                related[key].append(entity)
+            for item, key in zip(items, keys):
+                item.load_from_array({self.prop: related.get(key, [])}, consider_as_unchanged=True)
+        else:
+            if rows is not None:
+                keys = [row.get(self.prop) for row in rows]
+            else:
+                keys = get_link_keys(items, self.prop, self.chunk_size)
+            collection = self.collection()
+            related = {
+                entity.primary.get_value(deep=True): entity
+                for entity in self._fetch(collection.mapper.primary.name(), keys)
+            }
+            for item, key in zip(items, keys):
+                if key in related:
+                    item.load_from_array({self.prop: related[key]}, consider_as_unchanged=True)
+
+    def _fetch(self, prop: str, keys: list):
+        keys = list(filter(lambda k: k is not None, set(keys)))
+        for i in range(0, len(keys), self.chunk_size):
+            yield from self.collection().get_items({prop: ("in", keys[i:i + self.chunk_size])})
+
+    def _fetch_rows(self, prop: str, keys: list):
+        """ Выбирает связанные сущности вместе со значением внешнего ключа prop (одним запросом на порцию ключей)
+        :return: Пары (значение внешнего ключа, сущность)
+        """
+        collection = self.collection()
+        fields = get_column_properties(collection.mapper)
+        keys = list(filter(lambda k: k is not None, set(keys)))
+        for i in range(0, len(keys), self.chunk_size):
+            for row in collection.mapper.generate_rows(fields, {prop: ("in", keys[i:i + self.chunk_size])}, None):
+                yield row[prop], collection.get_new_item().load_from_array(dict(row), consider_as_unchanged=True)
+
+
+def prefetch(items: list, *relations: Prefetch, rows: list=None) -> list:
+    """ Пакетно загружает связи для списка сущностей
+    :param items: Список сущностей (например, результат get_items)
+    :param relations: Описания загружаемых связей
+    :param rows: Строки выборки сущностей в том же порядке (позволяют не читать внешние ключи повторно)
+    :return: Тот же список сущностей
+    """
+    for relation in relations:
+        relation.apply(items, rows)
+    return items
+
+
+_write_listeners = defaultdict(OrderedDict)
+
+
+def listen_writes(mapper, key, listener):
+    """ Подписывает обработчик на записи через маппер: сохранения сущностей z9 (EntityModel.persist),
+    update и delete коллекций z9. Записи в обход z9 (сущности и коллекции mapex) обработчик не получает
+    :param mapper: Класс или экземпляр маппера
+    :param key: Ключ подписки (повторная подписка с тем же ключом заменяет обработчик)
+    :param listener: Функция listener(saved, deleted, updated) - сохраненные сущности, первичные ключи удаленных записей
+    и первичные ключи записей, измененных update коллекции (сами записи не загружаются)
+    """
+    _write_listeners[get_mapper_class(mapper)][key] = listener
+
+
+def notify_writes(mapper, saved: list=None, deleted: list=None, updated: list=None):
+    """ Передает обработчикам маппера сведения о записи
+    :param mapper: Класс или экземпляр маппера
+    :param saved: Сохраненные сущности
+    :param deleted: Первичные ключи удаленных записей
+    :param updated: Первичные ключи измененных записей
+    """
+    for listener in list(_write_listeners.get(get_mapper_class(mapper), {}).values()):
+        listener(saved or [], deleted or [], updated or [])
+
+
+class CollectionModel(MapexCollectionModel):
+    """ Коллекция z9
+    Связи, перечисленные в prefetch_related, загружаются пакетно для всей выборки get_items;
+    для get_item загружаются только связи, явно переданные в параметре prefetch_related.
+    Выборки коллекции (как и любые читающие запросы) могут выполняться на репликах базы данных.
+    Если маппер зарегистрирован с кэшем (Database.register_mapper(mapper, cache=True)), результаты
+    get_items, get_item и count кэшируются до любой записи через маппер. Кэшируются строки выборки
+    (значения колонок таблицы), поэтому сущности не разделяются между запросами и их можно изменять
+    """
+    prefetch_related = []
+
+    def get_items(self, bounds=None, params=None, prefetch_related=None):
+        flush()
+        relations = self.prefetch_related if prefetch_related is None else prefetch_related
+        rows = self._cached_rows(("get_items", bounds, params), bounds, params)
+        if rows is None and relations:
+            # Внешние ключи связей выбираются вместе с сущностями, чтобы не читать их повторно
+            rows = self._rows(bounds, params)
+        if rows is None:
+            items = super(CollectionModel, self).get_items(bounds, params)
+        else:
+            items = [self._from_row(row) for row in rows]
+        identities = self._identities()
+        if identities is not None:
+            items = [identities.setdefault(item.primary.get_value(deep=True), item) for item in items]
+        return prefetch(list(items), *relations, rows=rows) if relations else items
+
+    def get_item(self, bounds=None, params=None, prefetch_related: list=None):
+        flush()
+        identities = self._identities()
+        key = self._identity_key(bounds) if identities is not None and not params else None
+        if key is not None and key in identities:
+            # Уже загруженная сущность возвращается без запроса, но запрошенные связи загружаются и для нее
+            item = identities[key]
+            return prefetch([item], *prefetch_related)[0] if prefetch_related else item
+
+        params_one = dict(params or {}, limit=1)
+        rows = self._cached_rows(("get_item", bounds, params), bounds, params_one)
+        if rows is None and prefetch_related:
+            rows = self._rows(bounds, params_one)
+        if rows is None:
+            item = super(CollectionModel, self).get_item(bounds, params)
+        else:
+            item = self._from_row(rows[0]) if rows else None
+        if item and identities is not None:
+            item = identities.setdefault(item.primary.get_value(deep=True), item)
+        if item and prefetch_related:
+            prefetch([item], *prefetch_related, rows=rows[:1] if rows is not None else None)
+        return item
+
+    def _identities(self):
+        """ Сущности маппера на текущем контуре в карте загруженных сущностей ({первичный ключ: сущность})
+        или None, если карта выключена
+        """
+        identities = _identities.get()
+        return identities.setdefault(identity_map_key(self.mapper), {}) if identities is not None else None
+
+    def _identity_key(self, bounds):
+        """ Первичный ключ, если ограничения выборки - это условие равенства первичного ключа, иначе None """
+        if isinstance(bounds, dict) and len(bounds) == 1:
+            (prop, value), = bounds.items()
+            if prop == self.mapper.primary.name() and isinstance(value, (str, int)):
+                return value
+        return None
+
+    def count(self, *args, **kwargs):
+        flush()
+        cache = self._query_cache()
+        if cache is None:
+            return super(CollectionModel, self).count(*args, **kwargs)
+        return cache.get_or_set(
+            (self.mapper.pool.database.contour, freeze(("count", args, kwargs))),
+            lambda: super(CollectionModel, self).count(*args, **kwargs)
+        )
+
+    def _query_cache(self):
+        """ Кэш выборок маппера или None, если кэш не включен или выполняется транзакция """
+        pool = getattr(self.mapper, "pool", None)
+        cache = pool.database.query_cache(self.mapper) if isinstance(pool, DatabasePool) else None
+        return None if cache is None or in_transaction() else cache
+
+    def _cached_rows(self, key, bounds, params):
+        """ Возвращает строки выборки (значения колонок таблицы) из кэша маппера или None, если кэш не используется
+        В кэше хранятся строки, а не сущности: каждая выборка создает собственные экземпляры сущностей
+        :param key: Описание выборки
+        :param bounds: Ограничения выборки
+        :param params: Параметры выборки
+        """
+        cache = self._query_cache()
+        if cache is None:
+            return None
+        return cache.get_or_set((self.mapper.pool.database.contour, freeze(key)), lambda: self._rows(bounds, params))
+
+    def _rows(self, bounds, params) -> tuple:
+        """ Строки выборки: значения всех колонок таблицы маппера (в том числе внешних ключей) """
+        return tuple(dict(row) for row in self.mapper.generate_rows(get_column_properties(self.mapper), bounds, params))
+
+    def _from_row(self, row: dict):
+        """ Создает сущность по копии закэшированной строки выборки """
+        return self.get_new_item().load_from_array(dict(row), consider_as_unchanged=True)
+
+    def from_row(self, row: dict):
+        """ Возвращает сущность по строке выборки (значениям колонок, например, из кэша прикладного кода)
+        Если сущность с тем же первичным ключом уже загружена в текущем запросе, возвращается она
+        :param row: Строка выборки {свойство: значение}
+        """
+        item = self._from_row(row)
+        identities = self._identities()
+        return identities.setdefault(item.primary.get_value(deep=True), item) if identities is not None else item
+
+    def update(self, data, bounds=None, *args, **kwargs):
+        if not _write_listeners.get(get_mapper_class(self.mapper)):
+            return super().update(data, bounds, *args, **kwargs)
+        with transaction(self.mapper.pool):
+            keys = self._primary_keys(bounds)
+            result = super().update(data, bounds, *args, **kwargs)
+        notify_writes(self.mapper, updated=keys)
+        return result
+
+    def delete(self, bounds=None, *args, **kwargs):
+        if not _write_listeners.get(get_mapper_class(self.mapper)):
+            return super().delete(bounds, *args, **kwargs)
+        with transaction(self.mapper.pool):
+            keys = self._primary_keys(bounds)
+            result = super().delete(bounds, *args, **kwargs)
+        notify_writes(self.mapper, deleted=keys)
+        return result
+
+    def _primary_keys(self, bounds) -> list:
+        """ Первичные ключи записей выборки (без создания сущностей) """
+        primary = self.mapper.primary.name()
+        return [row[primary] for row in self.mapper.generate_rows([primary], bounds, None)]
+
+    def generate_rows(self, fields: list, bounds=None, params=None):
+        """ Лениво возвращает строки выборки в виде словарей {свойство: значение}
+        Из базы данных выбираются только перечисленные свойства, сущности не создаются
+        :param fields: Список свойств
+        :param bounds: Ограничения выборки
+        :param params: Параметры выборки (order, skip, limit)
+        """
+        yield from self.mapper.generate_rows(fields, bounds, params)
+
+
+_unit_of_work = ContextVar("z9_unit_of_work", default=None)
+
+
+class UnitOfWork(object):
+    """ Отложенные сохранения сущностей
+    Каждая сущность сохраняется один раз (со всеми накопленными изменениями) в порядке первого вызова save()
+    """
+
+    def __init__(self):
+        self.entities = OrderedDict()
+
+    def register(self, entity: "EntityModel"):
+        """ Откладывает сохранение сущности до flush
+        :param entity: Сущность
+        """
+        self.entities.setdefault(id(entity), entity)
+
+    def flush(self):
+        """ Сохраняет все отложенные сущности в одной транзакции (на каждую базу данных) """
+        entities = list(self.entities.values())
+        self.entities.clear()
+        if not entities:
+            return
+        token = _unit_of_work.set(None)
+        try:
+            with ExitStack() as stack:
+                for mapper in OrderedDict((get_mapper_class(entity.mapper), None) for entity in entities):
+                    stack.enter_context(transaction(mapper.pool))
+                for entity in entities:
+                    entity.persist()
+        finally:
+            _unit_of_work.reset(token)
+
+
+@contextmanager
+def unit_of_work():
+    """ Откладывает сохранения сущностей z9 (EntityModel.save) до конца блока
+    Application выполняет в таком блоке обработку каждого запроса (Application.defer_saves).
+    Отложенные сущности сохраняются и при выходе из блока по исключению - так же, как если бы они были сохранены сразу
+    (ошибка такого сохранения записывается в лог, а наружу передается исходное исключение).
+    Перед любым запросом через маппер базы данных (чтением или записью, в том числе сущностью mapex) и перед выборкой
+    коллекции z9 из кэша отложенные сущности сохраняются, поэтому запросы видят те же данные, что и без блока.
+    Действия вне базы данных (письма, SMS) при этом выполняются раньше сохранения: если они зависят от сохраненных
+    данных, перед ними нужно вызвать flush(). Вложенные блоки присоединяются к внешнему
+    """
+    if _unit_of_work.get() is not None:
+        yield _unit_of_work.get()
+        return
+    uow = UnitOfWork()
+    token = _unit_of_work.set(uow)
+    try:
+        yield uow
+    except BaseException:
+        _unit_of_work.reset(token)
+        try:
+            uow.flush()
+        except Exception:
+            # Ошибка сохранения не должна подменять исключение, прервавшее блок
+            logger.exception("Unit of work flush failed after an error in the block")
+        raise
+    else:
+        _unit_of_work.reset(token)
+        uow.flush()
+
+
+def flush():
+    """ Немедленно сохраняет сущности, отложенные текущим блоком unit_of_work """
+    uow = _unit_of_work.get()
+    if uow is not None:
+        uow.flush()
+
+
+class EntityModel(MapexEntityModel):
+    """ Сущность z9
+    Внутри блока unit_of_work (в том числе при обработке запроса приложением) сохранение откладывается
+    до конца блока, вызова flush() или следующего запроса к базе данных. Новая сущность без первичного ключа
+    (автоинкремент) сохраняется сразу, чтобы ключ был известен после save().
+    Сущности моделей, унаследованных напрямую от mapex.EntityModel, сохраняются сразу
+    """
+
+    def save(self):
+        uow = _unit_of_work.get()
+        if uow is not None and self.primary.get_value(deep=True) is not None:
+            uow.register(self)
+            return self
+        return self.persist()
+
+    def persist(self):
+        """ Немедленно сохраняет сущность в базе данных и уведомляет обработчики записей маппера (listen_writes) """
+        result = super().save()
+        notify_writes(self.mapper, saved=[self])
+        return result
 
 
 class EntityModelTest(unittest.TestCase):
@@ -179,12 +1372,14 @@ class Phone(EmbeddedObject):
 
 
 class MigrationsMapper(SqlMapper):
+    @classmethod
     def up(cls):
         cls.pool.db.execute_raw(
             """
             CREATE TABLE IF NOT EXISTS `Migrations` (
               `Name` varchar(255) NOT NULL,
               `Created` datetime NOT NULL,
+              `Checksum` varchar(40) DEFAULT NULL,
               PRIMARY KEY (`Name`)
             ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
             """
@@ -197,9 +1392,13 @@ class MigrationsMapper(SqlMapper):
         self.set_map([
             self.str("name", "Name"),
             self.datetime("created", "Created"),
+            self.str("checksum", "Checksum"),
         ])
 
 
+MigrationsMapper.pool = BoundPool(MigrationsMapper)
+
+
 class Migration(EntityModel):
     mapper = MigrationsMapper
 
@@ -0,0 +1,704 @@
+""" Тестирование вспомогательных утилит ядра """
+import gc
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from contextvars import ContextVar, copy_context
+
+from mapex import SqlMapper, EntityModel
+from threading import Thread
+from z9.core.models import Database, Contours, ConnectionPool, Application, transaction, bind_pool, is_write_query
+from z9.core.models import identity_map, forget_identities, CollectionModel, unit_of_work, flush, ResponseBody
+from z9.core.models import Prefetch, Migration, Migrations, MigrationsMapper
+from z9.core.exceptions import PoolTimeout
+from z9.core.utils import LRUCache, Histogram, flat_dict, unflat_dict, copy_dict, migration_checksum, freeze
+from z9.core.utils import apply_migrations
+
+
+class LRUCacheTest(TestCase):
+    """ Тестирование кэша LRUCache """
+
+    def test_get_and_set(self):
+        """ Кэш возвращает сохраненное значение и считает попадания и промахи """
+        cache = LRUCache(maxsize=2)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(1, cache.get("a"))
+        self.assertEqual({"size": 1, "maxsize": 2, "hits": 1, "misses": 1, "hit_rate": 0.5}, cache.stats())
+
+    def test_eviction(self):
+        """ При переполнении вытесняется запись, к которой дольше всего не обращались """
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertIn("c", cache)
+
+    def test_ttl(self):
+        """ Устаревшие записи не возвращаются """
+        cache = LRUCache(maxsize=2, ttl=-1)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, len(cache))
+
+    def test_get_or_set(self):
+        """ Значение вычисляется только при отсутствии его в кэше """
+        cache = LRUCache()
+        calls = []
+        self.assertEqual(1, cache.get_or_set("a", lambda: calls.append(1) or 1))
+        self.assertEqual(1, cache.get_or_set("a", lambda: calls.append(1) or 1))
+        self.assertEqual(1, len(calls))
+
+    def test_invalidate(self):
+        """ Запись можно удалить из кэша """
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.invalidate("a")
+        self.assertNotIn("a", cache)
+
+
+class HistogramTest(TestCase):
+    """ Тестирование гистограммы """
+
+    def test_observe(self):
+        """ Значения распределяются по корзинам """
+        histogram = Histogram(buckets=(1, 10))
+        for value in (0.5, 5, 50):
+            histogram.observe(value)
+        self.assertEqual({"<=1": 1, "<=10": 1, "+inf": 1}, histogram.as_dict()["buckets"])
+        self.assertEqual(50, histogram.as_dict()["max"])
+
+
+class MigrationChecksumTest(TestCase):
+    """ Тестирование контрольных сумм миграций """
+
+    def test_checksum(self):
+        """ Контрольная сумма меняется при изменении текста миграции """
+        self.assertEqual(migration_checksum("SELECT 1"), migration_checksum("SELECT 1"))
+        self.assertNotEqual(migration_checksum("SELECT 1"), migration_checksum("SELECT 2"))
+        self.assertEqual(40, len(migration_checksum("")))
+
+
+class ApplyMigrationsTest(TestCase):
+    """ Тестирование применения миграций """
+
+    class Connection(object):
+        def __init__(self, columns=(("Checksum",),)):
+            self.db = self
+            self.columns = list(columns)
+            self.queries = []
+
+        def execute_raw(self, sql, params=None):
+            self.queries.append((" ".join(sql.split()), params))
+            if "GET_LOCK" in sql:
+                return [(1,)]
+            if sql.startswith("SHOW COLUMNS"):
+                return self.columns
+            return []
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        for name, sql in (("001.sql", "CREATE TABLE a (id int)"), ("002.sql", "CREATE TABLE b (id int)")):
+            with open(os.path.join(self.path, name), "w") as f:
+                f.write(sql)
+
+    def tearDown(self):
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        os.rmdir(self.path)
+
+    def test_empty_schema(self):
+        """ На пустой базе данных таблица миграций создается до обращения к ней, маппер создается после привязки пула """
+        connection = self.Connection()
+        instances = []
+        with patch.object(MigrationsMapper, "__init__", lambda self: instances.append(self.pool.primary())), \
+                patch.object(Migrations, "generate_rows", lambda self, fields: []), \
+                patch.object(Migration, "save", lambda self: None):
+            result = apply_migrations(self.path, connection, log=lambda message: None)
+        self.assertEqual(["001.sql", "002.sql"], result["applied"])
+        self.assertEqual([connection], instances)
+        queries = [sql for sql, params in connection.queries]
+        self.assertTrue(queries[0].startswith("SELECT GET_LOCK"))
+        self.assertTrue(queries[1].startswith("CREATE TABLE IF NOT EXISTS `Migrations`"))
+        self.assertTrue(queries[2].startswith("SHOW COLUMNS"))
+        self.assertEqual(["START TRANSACTION", "CREATE TABLE a (id int)", "COMMIT"], queries[3:6])
+        self.assertTrue(queries[-1].startswith("SELECT RELEASE_LOCK"))
+        self.assertFalse([sql for sql in queries if sql.startswith(("ALTER", "UPDATE"))])
+
+    def test_backfill_checksums(self):
+        """ Таблица без контрольных сумм дополняется колонкой, суммы заполняются одним запросом """
+        connection = self.Connection(columns=[])
+        rows = [{"name": "001.sql"}, {"name": "002.sql"}]
+        with patch.object(MigrationsMapper, "__init__", lambda self: None), \
+                patch.object(Migrations, "generate_rows", lambda self, fields: rows):
+            result = apply_migrations(self.path, connection, log=lambda message: None)
+        self.assertEqual([], result["applied"])
+        queries = [(sql, params) for sql, params in connection.queries if sql.startswith(("ALTER", "UPDATE"))]
+        self.assertEqual(2, len(queries))
+        self.assertTrue(queries[0][0].startswith("ALTER TABLE `Migrations` ADD COLUMN `Checksum`"))
+        self.assertEqual(
+            "UPDATE `Migrations` SET `Checksum` = CASE `Name` WHEN %s THEN %s WHEN %s THEN %s END "
+            "WHERE `Name` IN (%s, %s)", queries[1][0]
+        )
+        self.assertEqual((
+            "001.sql", migration_checksum("CREATE TABLE a (id int)"),
+            "002.sql", migration_checksum("CREATE TABLE b (id int)"), "001.sql", "002.sql"
+        ), queries[1][1])
+
+
+class FlatDictTest(TestCase):
+    """ Тестирование преобразований многомерных словарей """
+
+    def test_unflat_dict(self):
+        """ unflat_dict собирает многомерный словарь из плоского """
+        d = {"a": {"b": 1, "c": {"d": 2}}, "e": 3}
+        self.assertEqual(d, unflat_dict(flat_dict(d).items()))
+        self.assertEqual(2, unflat_dict(flat_dict(d).items()).a.c.d)
+
+    def test_copy_dict(self):
+        """ copy_dict копирует вложенные словари """
+        d = unflat_dict([("a.b", 1)])
+        c = copy_dict(d)
+        c.a.b = 2
+        self.assertEqual(1, d.a.b)
+
+
+class FreezeTest(TestCase):
+    """ Тестирование ключей кэша freeze """
+
+    class Entity(EntityModel):
+        def __init__(self, pk):
+            self.pk = pk
+
+        @property
+        def primary(self):
+            return self
+
+        def get_value(self, deep=False):
+            return self.pk
+
+    def test_entity_bounds(self):
+        """ Сущность в ограничениях представляется первичным ключом, а не экземпляром """
+        self.assertEqual(freeze({"account": self.Entity("a")}), freeze({"account": self.Entity("a")}))
+        self.assertNotEqual(freeze({"account": self.Entity("a")}), freeze({"account": self.Entity("b")}))
+        self.assertEqual(
+            freeze({"account": ("in", [self.Entity(1)])}), freeze({"account": ("in", [self.Entity(1)])})
+        )
+
+
+class DatabaseTest(TestCase):
+    """ Тестирование пулов соединений базы данных """
+
+    def setUp(self):
+        self.created = []
+
+        class TestDatabase(Database):
+            def create_pool(db, c, replica=0):
+                self.created.append(c)
+                return object()
+
+        self.db = TestDatabase(None, [], {Contours.UNITTESTS: "unittests", Contours.PRODUCTION: "production"})
+
+    def test_lazy_pool(self):
+        """ Пул создается только при первом обращении и только для текущего контура """
+        self.db.switch(Contours.PRODUCTION)
+        self.assertEqual([], self.created)
+        self.assertIs(self.db.pool, self.db.pool)
+        self.assertEqual([Contours.PRODUCTION], self.created)
+
+    def test_after_fork(self):
+        """ После fork пул создается заново, а унаследованный пул не уничтожается """
+        pool = self.db.pool
+        self.db.after_fork()
+        self.assertIsNot(pool, self.db.pool)
+        self.assertIn(pool, self.db._inherited_pools)
+        self.assertEqual([Contours.UNITTESTS, Contours.UNITTESTS], self.created)
+
+    def test_context_contour(self):
+        """ Контур, установленный в потоке, не влияет на другие потоки """
+        contours = []
+        with Application.using_contour(Contours.PRODUCTION):
+            thread = Thread(target=lambda: contours.append(self.db.contour))
+            thread.start()
+            thread.join()
+            contours.append(self.db.contour)
+        contours.append(self.db.contour)
+        self.assertEqual([Contours.UNITTESTS, Contours.PRODUCTION, Contours.UNITTESTS], contours)
+
+    def test_bind_pool(self):
+        """ Пул, привязанный к мапперу в контексте, имеет приоритет над пулом базы данных """
+        class TestMapper(SqlMapper):
+            pass
+
+        self.db.register_mapper(TestMapper)
+        pool = ConnectionPool(ConnectionPoolTest.Connection)
+        with bind_pool(TestMapper, pool):
+            self.assertIs(pool, TestMapper.pool.primary())
+        self.assertIsNot(pool, TestMapper.pool.primary())
+
+    def test_query_cache_invalidation(self):
+        """ Запись через маппер сбрасывает кэш выборок его самого и связанных мапперов """
+        class ReferenceMapper(SqlMapper):
+            pass
+
+        class DependentMapper(SqlMapper):
+            dependencies = [ReferenceMapper]
+
+        self.db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+        self.db.register_mapper(ReferenceMapper, cache=True)
+        self.db.register_mapper(DependentMapper)
+        cache = self.db.query_cache(ReferenceMapper)
+        self.assertIsNone(self.db.query_cache(DependentMapper))
+
+        cache.set("items", [1])
+        ReferenceMapper.pool.db.execute_raw("SELECT 1")
+        self.assertIn("items", cache)
+        DependentMapper.pool.db.execute_raw("DELETE")
+        self.assertNotIn("items", cache)
+
+    def test_query_cache_invalidation_after_commit(self):
+        """ Кэш, заполненный другим потоком во время транзакции, сбрасывается после её фиксации """
+        class TestMapper(SqlMapper):
+            pass
+
+        self.db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+        self.db.register_mapper(TestMapper, cache=True)
+        cache = self.db.query_cache(TestMapper)
+        with transaction(TestMapper.pool):
+            TestMapper.pool.db.execute_raw("UPDATE Test SET Name = 'a'")
+            cache.set("items", [1])
+            self.assertIn("items", cache)
+        self.assertNotIn("items", cache)
+
+    def test_query_cache_entities(self):
+        """ В кэше хранятся строки: каждая выборка возвращает собственные экземпляры сущностей """
+        class TestMapper(SqlMapper):
+            class column(object):
+                db_name = "Name"
+
+            @staticmethod
+            def get_properties():
+                return ["name"]
+
+            @staticmethod
+            def get_property(name):
+                return TestMapper.column
+
+            @staticmethod
+            def generate_rows(fields, bounds, params):
+                queries.append(fields)
+                return [{"name": "a"}]
+
+        class Entity(dict):
+            def load_from_array(self, data, consider_as_unchanged=False):
+                self.update(data)
+                return self
+
+        queries = []
+        self.db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+        self.db.register_mapper(TestMapper, cache=True)
+        collection = CollectionModel.__new__(CollectionModel)
+        collection.mapper, collection.prefetch_related = TestMapper, []
+        collection.get_new_item = Entity
+        first = collection.get_items()
+        first[0]["name"] = "b"
+        self.assertEqual([{"name": "a"}], collection.get_items())
+        self.assertEqual([["name"]], queries)
+
+    def test_query_stats(self):
+        """ Запросы учитываются в статистике маппера """
+        class TestMapper(SqlMapper):
+            pass
+
+        self.db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+        self.db.register_mapper(TestMapper)
+        TestMapper.pool.db.execute_raw("SELECT 1")
+        stats = self.db.stats()
+        self.assertEqual(1, stats["queries"]["TestMapper"]["count"])
+        self.assertEqual({"size": 1, "in_use": 1, "idle": 0, "checkouts": 1},
+                         {k: stats["pools"]["UNITTESTS"][k] for k in ("size", "in_use", "idle", "checkouts")})
+        self.db.reset_stats()
+        self.assertEqual(0, self.db.stats()["queries"]["TestMapper"]["count"])
+
+
+class ConnectionPoolTest(TestCase):
+    """ Тестирование пула соединений """
+
+    class Connection(object):
+        def __init__(self):
+            self.db = self
+            self.alive = True
+            self.closed = False
+
+        def execute_raw(self, sql):
+            if not self.alive:
+                raise ConnectionError()
+
+        def close(self):
+            self.closed = True
+
+    def setUp(self):
+        self.pool = ConnectionPool(self.Connection, min_size=0, max_size=1, overflow=1, checkout_timeout=0.01)
+
+    def test_thread_binding(self):
+        """ Поток работает с одним соединением до вызова release """
+        self.assertIs(self.pool.db, self.pool.db)
+        connection = self.pool.db
+        self.pool.release()
+        self.assertIs(connection, self.pool.db)
+
+    def test_overflow(self):
+        """ Соединения сверх max_size закрываются после возврата, а сверх overflow - не выдаются """
+        first, second = self.pool.checkout(), self.pool.checkout()
+        self.assertRaises(PoolTimeout, self.pool.checkout)
+        self.pool.checkin(second)
+        self.assertTrue(second.closed)
+        self.pool.checkin(first)
+        self.assertFalse(first.closed)
+        self.assertEqual(1, self.pool.size)
+
+    def test_validation(self):
+        """ Разорванное соединение, простаивавшее дольше validation_interval, не выдается повторно """
+        self.pool.validation_interval = -1
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        connection.alive = False
+        self.assertIsNot(connection, self.pool.checkout())
+        self.assertTrue(connection.closed)
+
+    def test_no_validation_after_short_idle(self):
+        """ Недавно возвращенное соединение выдается без проверочного запроса """
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        connection.alive = False
+        self.assertIs(connection, self.pool.checkout())
+
+    def test_idle_reaping(self):
+        """ Простаивающие соединения закрываются """
+        self.pool.idle_timeout = -1
+        connection = self.pool.checkout()
+        self.pool.checkin(connection)
+        self.pool.checkout()
+        self.assertTrue(connection.closed)
+
+    def test_thread_exit_without_release(self):
+        """ Соединение потока, завершившегося без release, возвращается в пул """
+        connections = []
+        thread = Thread(target=lambda: connections.append(self.pool.db))
+        thread.start()
+        thread.join()
+        gc.collect()
+        self.assertIs(connections[0], self.pool.checkout())
+        self.assertEqual(1, self.pool.size)
+
+
+class ResponseBodyTest(TestCase):
+    """ Тестирование отдачи тела ответа """
+
+    def test_body_in_request_context(self):
+        """ Тело ответа отдается в контексте запроса, ресурсы освобождаются после close """
+        var, released = ContextVar("test_var", default=None), []
+        context = copy_context()
+        context.run(var.set, "request")
+
+        def body():
+            yield var.get()
+            yield str(released)
+        response = ResponseBody(body(), context, lambda: released.append(var.get()))
+        self.assertEqual(["request", "[]"], list(response))
+        response.close()
+        self.assertEqual(["request"], released)
+        self.assertIsNone(var.get())
+
+class ReplicaRoutingTest(TestCase):
+    """ Тестирование распределения запросов между основным сервером и репликами """
+
+    def setUp(self):
+        self.db = Database(None, [], {Contours.UNITTESTS: {"primary": "primary", "replicas": ["r1", "r2"]}})
+        self.db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+
+    def tearDown(self):
+        self.db.release()
+
+    def test_reads_go_to_replica(self):
+        """ Чтения выполняются на одной реплике в течение запроса """
+        replica = self.db.route(write=False)
+        self.assertIsNot(self.db.pool, replica)
+        self.assertIs(replica, self.db.route(write=False))
+
+    def test_round_robin(self):
+        """ Реплики выбираются по кругу """
+        first = self.db.route(write=False)
+        self.db.release()
+        self.assertIsNot(first, self.db.route(write=False))
+
+    def test_read_your_writes(self):
+        """ После записи чтения запроса выполняются на основном сервере """
+        self.assertIs(self.db.pool, self.db.route(write=True))
+        self.assertIs(self.db.pool, self.db.route(write=False))
+
+    def test_release_connections(self):
+        """ Соединения возвращаются в пулы до конца запроса без смены сервера, выбранного для чтений """
+        self.db.route(write=True).db
+        self.db.release_connections()
+        self.assertEqual(0, self.db.pool.in_use)
+        self.assertIs(self.db.pool, self.db.route(write=False))
+
+    def test_transaction(self):
+        """ Чтения внутри транзакции выполняются на основном сервере """
+        with transaction(self.db.pool):
+            self.assertIs(self.db.pool, self.db.route(write=False))
+
+    def test_query_kind(self):
+        """ Вид запроса определяется по команде SQL или имени метода соединения """
+        self.assertFalse(is_write_query("execute_raw", (" select * from Accounts",)))
+        self.assertFalse(is_write_query("execute_raw", ("SHOW COLUMNS FROM `Migrations`",)))
+        self.assertTrue(is_write_query("execute_raw", ("SELECT * FROM Accounts FOR UPDATE",)))
+        self.assertTrue(is_write_query("execute_raw", ("UPDATE Accounts SET Name = 'a'",)))
+        self.assertTrue(is_write_query("execute_raw", ("START TRANSACTION",)))
+        self.assertFalse(is_write_query("select_query", ("Accounts", ["ID"])))
+        self.assertFalse(is_write_query("count_query", ()))
+        self.assertTrue(is_write_query("insert_query", ()))
+        self.assertTrue(is_write_query("unknown", ()))
+
+    def test_mapper_connection_routing(self):
+        """ Соединение маппера направляет чтения на реплику, а запись и последующие чтения - на основной сервер """
+        class TestMapper(SqlMapper):
+            pass
+
+        self.db.register_mapper(TestMapper)
+        TestMapper.pool.db.execute_raw("SELECT 1")
+        replica = self.db.route(write=False)
+        self.assertIsNot(self.db.pool, replica)
+        self.assertEqual(1, replica.checkouts)
+        self.assertEqual(0, self.db.pool.checkouts)
+        TestMapper.pool.db.execute_raw("DELETE FROM Test")
+        self.assertEqual(1, self.db.pool.checkouts)
+        self.assertIs(self.db.pool, self.db.route(write=False))
+
+    def test_write_does_not_check_out_replica(self):
+        """ Запись, выполненная первой в запросе, не занимает соединение с репликой """
+        class TestMapper(SqlMapper):
+            pass
+
+        self.db.register_mapper(TestMapper)
+        TestMapper.pool.db.execute_raw("SELECT 1")
+        self.db.release()
+        TestMapper.pool.db.execute_raw("DELETE FROM Test")
+        self.assertEqual(1, self.db.pool.checkouts)
+        self.assertEqual(1, sum(self.db.get_pool(self.db.contour, replica).checkouts for replica in (1, 2)))
+
+
+class IdentityMapTest(TestCase):
+    """ Тестирование карты загруженных сущностей """
+
+    class Mapper(SqlMapper):
+        pass
+
+    def test_scope(self):
+        """ Карта существует только внутри блока identity_map """
+        collection = CollectionModel.__new__(CollectionModel)
+        collection.mapper = self.Mapper
+        self.assertIsNone(collection._identities())
+        with identity_map():
+            collection._identities()["login"] = "entity"
+            self.assertEqual({"login": "entity"}, collection._identities())
+            forget_identities(self.Mapper)
+            self.assertEqual({}, collection._identities())
+        self.assertIsNone(collection._identities())
+
+    def test_contours(self):
+        """ Сущности одного маппера на разных контурах хранятся раздельно """
+        collection = CollectionModel.__new__(CollectionModel)
+        collection.mapper = self.Mapper
+        with identity_map():
+            collection._identities()["login"] = "entity"
+            with Application.using_contour(Contours.PRODUCTION):
+                self.assertEqual({}, collection._identities())
+            self.assertEqual({"login": "entity"}, collection._identities())
+
+
+class PrefetchTest(TestCase):
+    """ Тестирование пакетной загрузки связей """
+
+    class Entity(dict):
+        class Primary(object):
+            def __init__(self, entity):
+                self.entity = entity
+
+            def get_value(self, deep=False):
+                return self.entity["id"]
+
+        @property
+        def primary(self):
+            return self.Primary(self)
+
+        def load_from_array(self, data, consider_as_unchanged=False):
+            self.update(data)
+            return self
+
+    def collection(self, name, rows):
+        """ Коллекция над таблицей в памяти, выборки которой записываются в self.queries """
+        test = self
+
+        class TestMapper(SqlMapper):
+            class column(object):
+                db_name = "Column"
+
+            class primary(object):
+                @staticmethod
+                def name():
+                    return "id"
+
+            @staticmethod
+            def get_properties():
+                return list(rows[0])
+
+            @staticmethod
+            def get_property(prop):
+                return TestMapper.column
+
+            @staticmethod
+            def generate_rows(fields, bounds, params):
+                test.queries.append((name, dict(bounds or {})))
+                for prop, (operator, keys) in (bounds or {}).items():
+                    return [row for row in rows if row[prop] in keys]
+                return rows
+
+        collection = CollectionModel.__new__(CollectionModel)
+        collection.mapper, collection.prefetch_related = TestMapper, []
+        collection.get_new_item = self.Entity
+        return collection
+
+    def setUp(self):
+        self.queries = []
+        self.settings = self.collection("settings", [{"id": 10, "account": 1}, {"id": 11, "account": 1}])
+        self.accounts = self.collection("accounts", [{"id": 1, "group": 5}, {"id": 2, "group": 6}])
+        self.groups = self.collection("groups", [{"id": 5}])
+        self.groups.get_items = lambda bounds=None, params=None: [
+            self.Entity(row) for row in self.groups.mapper.generate_rows(["id"], bounds, params)
+        ]
+
+    def test_via(self):
+        """ Обратная связь загружается одним запросом и группируется по внешнему ключу из той же выборки """
+        items = self.accounts.get_items(prefetch_related=[Prefetch("settings", lambda: self.settings, via="account")])
+        self.assertEqual(["accounts", "settings"], [name for name, bounds in self.queries])
+        self.assertEqual([10, 11], [setting["id"] for setting in items[0]["settings"]])
+        self.assertEqual([], items[1]["settings"])
+
+    def test_identity_map_hit(self):
+        """ Для сущности из карты загруженных сущностей запрошенные связи тоже загружаются """
+        with identity_map():
+            loaded = self.accounts.from_row({"id": 1, "group": 5})
+            item = self.accounts.get_item(
+                {"id": 1}, prefetch_related=[Prefetch("settings", lambda: self.settings, via="account")]
+            )
+        self.assertIs(loaded, item)
+        self.assertEqual(["settings"], [name for name, bounds in self.queries])
+        self.assertEqual([10, 11], [setting["id"] for setting in item["settings"]])
+
+    def test_link(self):
+        """ Внешние ключи ссылок берутся из основной выборки, а не читаются повторно """
+        items = self.accounts.get_items(prefetch_related=[Prefetch("group", lambda: self.groups)])
+        self.assertEqual([("accounts", {}), ("groups", {"id": ("in", [5, 6])})],
+                         [(name, {k: (op, sorted(v)) for k, (op, v) in bounds.items()}) for name, bounds in self.queries])
+        self.assertEqual({"id": 5}, items[0]["group"])
+        self.assertEqual(6, items[1]["group"])
+
+
+class UnitOfWorkTest(TestCase):
+    """ Тестирование отложенных сохранений """
+
+    class Entity(object):
+        class mapper(SqlMapper):
+            pool = ConnectionPool(ConnectionPoolTest.Connection)
+
+        def __init__(self, saved, pk=1):
+            self.saved = saved
+            self.pk = pk
+
+        @property
+        def primary(self):
+            return self
+
+        def get_value(self, deep=False):
+            return self.pk
+
+        def save(self):
+            from z9.core.models import EntityModel
+            return EntityModel.save(self)
+
+        def persist(self):
+            self.saved.append(self)
+
+    def test_coalesced_saves(self):
+        """ Сущность сохраняется один раз в конце блока """
+        saved = []
+        first, second = self.Entity(saved), self.Entity(saved)
+        with unit_of_work():
+            first.save()
+            second.save()
+            first.save()
+            self.assertEqual([], saved)
+        self.assertEqual([first, second], saved)
+
+    def test_new_entity_saved_immediately(self):
+        """ Новая сущность без первичного ключа сохраняется сразу, чтобы ключ был известен после save """
+        saved = []
+        entity = self.Entity(saved, pk=None)
+        with unit_of_work():
+            entity.save()
+            self.assertEqual([entity], saved)
+
+    def test_flush(self):
+        """ flush сохраняет отложенные сущности немедленно """
+        saved = []
+        entity = self.Entity(saved)
+        with unit_of_work():
+            entity.save()
+            flush()
+            self.assertEqual([entity], saved)
+        self.assertEqual([entity], saved)
+
+    def test_saved_on_exception(self):
+        """ Сущности, сохраненные до исключения, сохраняются """
+        saved = []
+        entity = self.Entity(saved)
+        with self.assertRaises(ValueError):
+            with unit_of_work():
+                entity.save()
+                raise ValueError()
+        self.assertEqual([entity], saved)
+
+    def test_flush_error_keeps_original_exception(self):
+        """ Ошибка сохранения при выходе по исключению не подменяет исходное исключение """
+        class Broken(self.Entity):
+            def persist(self):
+                raise RuntimeError()
+
+        with self.assertRaises(ValueError), self.assertLogs("z9.core.models", "ERROR"):
+            with unit_of_work():
+                Broken([]).save()
+                raise ValueError()
+
+    def test_flush_before_query(self):
+        """ Перед любым запросом через маппер (чтением или записью сущностью mapex) отложенные сущности сохраняются """
+        class TestMapper(SqlMapper):
+            pass
+
+        db = Database(None, [], {Contours.UNITTESTS: "unittests"})
+        db.create_pool = lambda c, replica=0: ConnectionPool(ConnectionPoolTest.Connection)
+        db.register_mapper(TestMapper)
+        saved = []
+        entity = self.Entity(saved)
+        with unit_of_work():
+            entity.save()
+            TestMapper.pool.db.execute_raw("SELECT 1")
+            self.assertEqual([entity], saved)
+            entity.save()
+            TestMapper.pool.db.execute_raw("UPDATE Test SET AccountID = 'new'")
+            self.assertEqual([entity, entity], saved)
@@ -7,14 +7,17 @@ import unittest
 import webtest
 import json
 import time
+from threading import RLock, Lock
+from contextlib import contextmanager
+from collections import OrderedDict
 from datetime import datetime
 from itertools import filterfalse, chain
 from importlib import import_module
 from inspect import getmembers
 from fcntl import flock, LOCK_EX, LOCK_NB
 
-from .exceptions import CommonException
-from mapex import Pool
+from .exceptions import CommonException, MigrationsLocked
+from mapex import Pool, EntityModel, EmbeddedObject
 
 root_path = "%s/../" % os.path.dirname(os.path.abspath(__file__))
 
@@ -143,44 +146,162 @@ class bcolors:
     UNDERLINE = '\033[4m'
 
 
-def apply_migrations(migrations_path, pool: Pool):
+def reset_migrations_mapper():
+    """ Сбрасывает маппер таблицы миграций
+    Новый экземпляр создается при применении миграций, когда пул базы данных уже привязан (bind_pool)
+    и таблица миграций существует. При параллельном применении миграций нескольких баз данных
+    вызывается один раз до запуска потоков
+    """
     from z9.core.models import Migration
 
     Migration.mapper.kill_instance()
-    Migration.mapper.pool = pool
 
-    migrations = sorted(os.listdir(migrations_path)) if migrations_path and os.path.exists(migrations_path) else []
-    if not len(migrations):
-        print("{color1}There are no migrations".format(
-            color1=bcolors.WARNING,
-            end=bcolors.ENDC,
-            path=migrations_path
-        ))
+
+def apply_migrations(migrations_path, pool: Pool, plan=False, log=print, reset_mapper=True) -> dict:
+    """ Применяет новые миграции из каталога migrations_path
+    Примененные миграции загружаются одним запросом, а новые определяются сравнением со списком файлов.
+    Каждая миграция выполняется и регистрируется в одной транзакции
+    (DDL-инструкции MySQL все равно фиксируются сразу).
+    Одновременное применение миграций одной базы данных несколькими процессами исключается блокировкой GET_LOCK
+    @param migrations_path: Каталог с файлами миграций
+    @param pool: Пул соединений базы данных
+    @param plan: Только вывести список миграций, которые будут применены
+    @param log: Функция вывода сообщений (например, с префиксом базы данных при параллельном применении)
+    @param reset_mapper: Сбросить маппер таблицы миграций (при параллельном применении - False,
+    маппер сбрасывается один раз функцией reset_migrations_mapper)
+    @return: {"applied": [...], "pending": [...], "changed": [...], "elapsed": секунды}
+    """
+    from z9.core.models import Migration, bind_pool
+
+    if reset_mapper:
+        reset_migrations_mapper()
+    # Пул привязывается только в текущем потоке, поэтому миграции разных баз данных могут применяться параллельно
+    with bind_pool(Migration.mapper, pool):
+        if plan:
+            return _apply_migrations(migrations_path, pool, plan, log)
+        with migrations_lock(pool):
+            return _apply_migrations(migrations_path, pool, plan, log)
+
+
+def migration_checksum(sql: str) -> str:
+    """ Контрольная сумма содержимого миграции
+    @param sql: Текст миграции
+    """
+    return hashlib.sha1(sql.encode()).hexdigest()
+
+
+MIGRATIONS_LOCK = "z9_migrations"
+MIGRATIONS_LOCK_TIMEOUT = 600
+_migrations_mapper_lock = Lock()
+
+
+@contextmanager
+def migrations_lock(pool: Pool, timeout=MIGRATIONS_LOCK_TIMEOUT):
+    """ Блокировка применения миграций базы данных (GET_LOCK держится соединением до RELEASE_LOCK)
+    @param pool: Пул соединений базы данных
+    @param timeout: Время ожидания блокировки в секундах
+    """
+    rows = raw_rows(pool.db.execute_raw("SELECT GET_LOCK(%s, %s)", (MIGRATIONS_LOCK, timeout)))
+    if not rows or rows[0][0] != 1:
+        raise MigrationsLocked(MIGRATIONS_LOCK)
+    try:
+        yield
+    finally:
+        pool.db.execute_raw("SELECT RELEASE_LOCK(%s)", (MIGRATIONS_LOCK,))
+
+
+def _prepare_migrations_table(pool: Pool, plan: bool):
+    """ Создает таблицу миграций и дополняет колонкой Checksum таблицу, созданную до появления контрольных сумм
+    В режиме plan база данных не изменяется
+    @return: (таблица существует, колонка Checksum существует)
+    """
+    from z9.core.models import MigrationsMapper
+
+    if plan:
+        if not raw_rows(pool.db.execute_raw("SHOW TABLES LIKE 'Migrations'")):
+            return False, False
+    else:
+        MigrationsMapper.up()
+    if raw_rows(pool.db.execute_raw("SHOW COLUMNS FROM `Migrations` LIKE 'Checksum'")):
+        return True, True
+    if plan:
+        return True, False
+    pool.db.execute_raw("ALTER TABLE `Migrations` ADD COLUMN `Checksum` varchar(40) DEFAULT NULL")
+    return True, True
+
+
+def _backfill_checksums(pool: Pool, checksums: dict):
+    """ Заполняет контрольные суммы миграций, примененных до их появления, одним запросом
+    @param checksums: {имя миграции: контрольная сумма}
+    """
+    if not checksums:
         return
+    names = sorted(checksums)
+    pool.db.execute_raw(
+        "UPDATE `Migrations` SET `Checksum` = CASE `Name` %s END WHERE `Name` IN (%s)" % (
+            " ".join(["WHEN %s THEN %s"] * len(names)), ", ".join(["%s"] * len(names))
+        ),
+        tuple(chain.from_iterable((name, checksums[name]) for name in names)) + tuple(names)
+    )
 
-    for file in migrations:
-        migration = Migration({'name': file, 'created': datetime.today()})
-
-        if not migration.get_new_collection().get_item({"name": migration.name}):
-            print("{color1} APPLY{end}: {color2}{migration}{end}".format(
-                color1=bcolors.OKGREEN,
-                color2=bcolors.WARNING + bcolors.BOLD,
-                end=bcolors.ENDC,
-                migration=file
-            ))
 
-            with open("%s/%s" % (migrations_path, file)) as f:
-                migration.mapper.pool.db.execute_raw(f.read())
+def _apply_migrations(migrations_path, pool: Pool, plan: bool, log) -> dict:
+    from z9.core.models import Migration, Migrations, transaction
 
-            migration.save()
-        else:
-            print("{color1}IGNORE{end}: {color2}{migration}{end}".format(
-                color1=bcolors.OKBLUE,
-                color2=bcolors.WARNING,
-                end=bcolors.ENDC,
-                migration=file
+    started = time.time()
+    result = {"applied": [], "pending": [], "changed": [], "elapsed": 0.0}
+    migrations = sorted(os.listdir(migrations_path)) if migrations_path and os.path.exists(migrations_path) else []
+    if not len(migrations):
+        log("{color1}There are no migrations{end}".format(color1=bcolors.WARNING, end=bcolors.ENDC))
+        return result
+
+    has_table, has_checksum = _prepare_migrations_table(pool, plan)
+    applied = {}
+    if has_table:
+        # Маппер создается после таблицы и один раз на все потоки
+        with _migrations_mapper_lock:
+            Migration.mapper()
+        fields = ["name", "checksum"] if has_checksum else ["name"]
+        applied = {row["name"]: row.get("checksum") for row in Migrations().generate_rows(fields)}
+    backfill = {}
+    for file in migrations:
+        with open("%s/%s" % (migrations_path, file)) as f:
+            sql = f.read()
+        checksum = migration_checksum(sql)
+
+        if file not in applied:
+            result["pending"].append(file)
+            if plan:
+                log("{color1}  PLAN{end}: {color2}{migration}{end}".format(
+                    color1=bcolors.OKGREEN, color2=bcolors.WARNING + bcolors.BOLD, end=bcolors.ENDC, migration=file
+                ))
+                continue
+            migration_started = time.time()
+            with transaction(pool):
+                pool.db.execute_raw(sql)
+                Migration({"name": file, "created": datetime.today(), "checksum": checksum}).save()
+            result["applied"].append(file)
+            log("{color1} APPLY{end}: {color2}{migration}{end} ({elapsed:.3f} sec)".format(
+                color1=bcolors.OKGREEN, color2=bcolors.WARNING + bcolors.BOLD, end=bcolors.ENDC,
+                migration=file, elapsed=time.time() - migration_started
+            ))
+        elif applied[file] is None:
+            backfill[file] = checksum
+        elif applied[file] != checksum:
+            result["changed"].append(file)
+            log("{color1}CHANGED{end}: {color2}{migration}{end} was edited after it had been applied".format(
+                color1=bcolors.FAIL, color2=bcolors.WARNING, end=bcolors.ENDC, migration=file
             ))
 
+    if not plan:
+        _backfill_checksums(pool, backfill)
+    result["elapsed"] = time.time() - started
+    log("{color1}{verb} {pending} of {total} migrations{end} ({elapsed:.3f} sec)".format(
+        color1=bcolors.OKBLUE, end=bcolors.ENDC, verb="Pending" if plan else "Applied",
+        pending=len(result["pending"]), total=len(migrations), elapsed=result["elapsed"]
+    ))
+    return result
+
 
 class FunctionalTestCase(unittest.TestCase):
     """ Класс для создания функциональных тестов """
@@ -312,6 +433,43 @@ class flexdict(dict):
         self.__delitem__(item)
 
 
+def freeze(obj):
+    """ Возвращает неизменяемое (хэшируемое) представление структуры данных, не зависящее от порядка ключей
+    Сущности представляются классом и первичным ключом, встроенные объекты - значением для базы данных,
+    поэтому одинаковые ограничения с разными экземплярами сущностей дают одинаковый ключ кэша
+    @param obj: Словарь, список, множество, сущность или скалярное значение
+    """
+    if isinstance(obj, EntityModel):
+        return type(obj).__name__, freeze(obj.primary.get_value(deep=True))
+    if isinstance(obj, EmbeddedObject):
+        return type(obj).__name__, freeze(obj.get_value())
+    if isinstance(obj, dict):
+        return tuple(sorted(((str(key), freeze(value)) for key, value in obj.items()), key=lambda p: p[0]))
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    if isinstance(obj, (set, frozenset)):
+        return tuple(sorted((freeze(value) for value in obj), key=repr))
+    try:
+        hash(obj)
+        return obj
+    except TypeError:
+        return repr(obj)
+
+
+def escape_like(value: str) -> str:
+    """ Экранирует символы шаблона LIKE (%, _ и символ экранирования), чтобы значение искалось как подстрока
+    :param value: Значение, введенное пользователем
+    """
+    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def raw_rows(result) -> list:
+    """ Возвращает строки результата execute_raw в виде списка кортежей (драйверы возвращают кортежи или словари)
+    :param result: Результат execute_raw
+    """
+    return [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in result or []]
+
+
 def flat_dict(d: dict, sep=".", cls=flexdict):
     """ Делает многомерный словарь плоским; конкатенирует ключи вложенных массивов """
     res = cls()
@@ -325,6 +483,37 @@ def flat_dict(d: dict, sep=".", cls=flexdict):
     return res
 
 
+def unflat_dict(items, sep=".", cls=flexdict):
+    """ Собирает многомерный словарь из пар (составной ключ, значение) за один проход; обратна flat_dict
+    @param items: Итерируемая коллекция пар (ключ, значение), например, flat_dict(d).items()
+    @param sep: Разделитель частей ключа
+    @param cls: Класс словарей результата
+    """
+    res = cls()
+    for key, value in items:
+        node = res
+        *path, last = key.split(sep)
+        for part in path:
+            child = dict.get(node, part)
+            if not isinstance(child, dict):
+                child = cls()
+                dict.__setitem__(node, part, child)
+            node = child
+        dict.__setitem__(node, last, value)
+    return res
+
+
+def copy_dict(d: dict, cls=flexdict):
+    """ Возвращает глубокую копию многомерного словаря (копируются только вложенные словари)
+    @param d: Исходный словарь
+    @param cls: Класс словарей результата
+    """
+    res = cls()
+    for key, value in d.items():
+        dict.__setitem__(res, key, copy_dict(value, cls) if isinstance(value, dict) else value)
+    return res
+
+
 class Profiler(object):
     def __init__(self):
         self._startTime = 0
@@ -337,4 +526,164 @@ class Profiler(object):
         pass
 
     def get_amount(self):
-        return "Elapsed time: {:.3f} sec".format(time.time() - self._startTime)
\ No newline at end of file
+        return "Elapsed time: {:.3f} sec".format(time.time() - self._startTime)
+
+
+class LRUCache(object):
+    """ Потокобезопасный кэш с вытеснением давно не использовавшихся записей (LRU) и временем жизни записей (TTL)
+    @param maxsize: Максимальное количество записей в кэше
+    @param ttl: Время жизни записи в секундах (None - записи не устаревают)
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._tags = {}
+        self._lock = RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self._missing, count=False) is not self._missing
+
+    def get(self, key, default=None, count=True):
+        """ Возвращает значение из кэша по ключу
+        @param key: Ключ
+        @param default: Значение, возвращаемое при отсутствии ключа в кэше
+        @param count: Учитывать ли обращение в статистике попаданий
+        """
+        with self._lock:
+            entry = self._data.get(key, self._missing)
+            if entry is not self._missing and self.ttl is not None and entry[1] < time.monotonic():
+                self._remove(key)
+                entry = self._missing
+            if entry is self._missing:
+                if count:
+                    self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, tag=None):
+        """ Помещает значение в кэш, вытесняя самые старые записи при переполнении
+        @param key: Ключ
+        @param value: Значение
+        @param tag: Метка записи для группового удаления через invalidate_tag
+        """
+        with self._lock:
+            self._remove(key)
+            expires = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._data[key] = (value, expires, tag)
+            if tag is not None:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+        return value
+
+    def get_or_set(self, key, cb, tag=None):
+        """ Возвращает значение из кэша, а при его отсутствии вычисляет выражение cb и кэширует результат
+        @param key: Ключ
+        @param cb: Лямбда для получения значения
+        @param tag: Метка записи для группового удаления через invalidate_tag
+        """
+        value = self.get(key, self._missing)
+        return self.set(key, cb(), tag) if value is self._missing else value
+
+    def invalidate(self, key):
+        """ Удаляет запись из кэша
+        @param key: Ключ
+        """
+        with self._lock:
+            self._remove(key)
+
+    def invalidate_tag(self, tag):
+        """ Удаляет из кэша все записи с указанной меткой
+        @param tag: Метка
+        """
+        with self._lock:
+            for key in self._tags.pop(tag, ()):
+                self._data.pop(key, None)
+
+    def clear(self):
+        """ Очищает кэш """
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self._tags.get(entry[2])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[entry[2]]
+
+    def stats(self) -> dict:
+        """ Возвращает статистику использования кэша """
+        requests = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0
+        }
+
+    def reset_stats(self):
+        """ Сбрасывает счетчики попаданий и промахов """
+        self.hits = 0
+        self.misses = 0
+
+
+class Histogram(object):
+    """ Потокобезопасная гистограмма значений (например, длительностей в секундах)
+    @param buckets: Верхние границы корзин по возрастанию; значения больше последней границы попадают в корзину +inf
+    """
+    default_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self._lock = RLock()
+        self.reset()
+
+    def observe(self, value):
+        """ Учитывает значение
+        @param value: Значение
+        """
+        with self._lock:
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+
+    def reset(self):
+        """ Сбрасывает все значения """
+        with self._lock:
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def as_dict(self) -> dict:
+        """ Возвращает гистограмму в виде словаря """
+        with self._lock:
+            return {
+                "count": self.count,
+                "total": self.total,
+                "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "buckets": dict(zip(["<=%s" % b for b in self.buckets] + ["+inf"], self.counts))
+            }
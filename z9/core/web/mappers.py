@@ -0,0 +1,42 @@
+from mapex import SqlMapper
+
+
+class SearchIndexMapper(SqlMapper):
+    """ Маппер поискового индекса колонок таблиц """
+
+    def bind(self):
+        """ Настраиваем маппинг """
+        from z9.core.web.models import SearchIndexEntry, SearchIndexEntries
+        self.set_new_item(SearchIndexEntry)
+        self.set_new_collection(SearchIndexEntries)
+        self.set_collection_name("SearchIndex")
+        self.set_map([
+            self.int("id", "ID"),
+            self.str("collection", "Collection"),
+            self.str("field", "Field"),
+            self.str("row_id", "RowID"),
+            self.str("token", "Token"),
+        ])
+
+    @classmethod
+    def up(cls):
+        cls.pool.db.execute_raw(
+            """
+            CREATE TABLE IF NOT EXISTS `SearchIndex` (
+                `ID` INT(11) NOT NULL AUTO_INCREMENT,
+                `Collection` VARCHAR(64) NOT NULL,
+                `Field` VARCHAR(64) NOT NULL,
+                `RowID` VARCHAR(255) NOT NULL,
+                `Token` VARCHAR(16) NOT NULL,
+                PRIMARY KEY (`ID`),
+                INDEX `Lookup` (`Collection`, `Field`, `Token`),
+                INDEX `Row` (`Collection`, `RowID`)
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+            """
+        )
+
+    @classmethod
+    def down(cls):
+        cls.pool.db.execute_raw(
+            """DROP TABLE IF EXISTS `SearchIndex`;"""
+        )
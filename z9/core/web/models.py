@@ -1,10 +1,25 @@
 """ Модели для веб разработки """
-from mapex import EntityModel, CollectionModel, EmbeddedObject
-from collections import OrderedDict
+import io
+import csv
+import json
+import time
+import logging
+import weakref
+import tempfile
+import contextvars
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from mapex import EntityModel, EmbeddedObject
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from envi import Request
 from z9.core.exceptions import CommonException
+from z9.core.models import CollectionModel, EntityModel as Z9EntityModel, get_mapper_class, get_column_name, \
+    get_contour, get_table_name, is_link_property, transaction, listen_writes, flush, prefetch
+from z9.core.web.mappers import SearchIndexMapper
 from math import ceil
-from z9.core.utils import pretty_print
+from z9.core.utils import pretty_print, freeze, escape_like, raw_rows, LRUCache
+
+logger = logging.getLogger(__name__)
 
 
 class MenuItem(object):
@@ -15,16 +30,31 @@ class MenuItem(object):
     :param css_class: css-класс пункта меню
     :param sub_menu: Подменю
     """
+    __slots__ = ("url", "alias", "css_class", "url_map", "sub_menu", "_parent", "__weakref__")
 
     def __init__(self, url: str, alias: str, css_class=None, sub_menu=None):
         self.url = url
         self.alias = alias
         self.css_class = css_class if css_class else ""
         self.url_map = {self.url: self}
-        self.parent = Menu()
+        self._parent = None
         self.sub_menu = sub_menu if sub_menu else Menu()
         self.sub_menu.parent = self
 
+    @property
+    def parent(self):
+        """ Меню, в котором находится пункт (хранится слабая ссылка, чтобы не создавать циклов ссылок) """
+        return self._parent() if self._parent else None
+
+    @parent.setter
+    def parent(self, menu):
+        self._parent = weakref.ref(menu) if menu is not None else None
+
+    @property
+    def path(self) -> tuple:
+        """ Части URL элемента меню """
+        return Menu.split_url(self.url)
+
     def append(self, items):
         """
         Добавляет новые элементы в текущий пункт меню
@@ -32,6 +62,14 @@ class MenuItem(object):
         """
         self.sub_menu.append(items)
         self.url_map.update(self.sub_menu.items_map)
+        menu = self.parent
+        while menu is not None:
+            menu.items_map.update(self.url_map)
+            menu.reset()
+            if menu.parent is None:
+                break
+            menu.parent.url_map.update(self.url_map)
+            menu = menu.parent.parent
 
     def get_data(self, url=None) -> dict:
         """ Возвращает описание пункта меню в виде словаря """
@@ -40,24 +78,44 @@ class MenuItem(object):
             "alias": self.alias,
             "css_class": self.css_class,
             "childs": self.sub_menu.get_full(),
-            "active": url and (url.rstrip("/") + "/").startswith(self.url.rstrip("/") + "/")
+            "active": bool(url) and (url.rstrip("/") + "/").startswith(self.url.rstrip("/") + "/")
         }
 
     @property
     def breadcrumbs(self) -> list:
         """ Хлебные крошки для текущего пункта меню """
-        return self.parent.breadcrumbs + [{"url": self.url, "alias": self.alias}]
+        return (self.parent.breadcrumbs if self.parent else []) + [{"url": self.url, "alias": self.alias}]
 
 
 class Menu(object):
-    """ Меню """
+    """ Меню
+    При первом обращении меню компилируется в префиксное дерево URL (CompiledMenu): активный пункт
+    определяется по самому длинному совпадающему префиксу URL, а данные меню для каждого пункта запоминаются
+    """
+    __slots__ = ("items", "items_map", "_parent", "_compiled", "__weakref__")
+
     def __init__(self, items: list=None):
-        self.parent = None
+        self._parent = None
+        self._compiled = None
         self.items = []
         self.items_map = {}
         if items:
             self.append(items)
 
+    @property
+    def parent(self):
+        """ Пункт меню, которому принадлежит подменю (хранится слабая ссылка) """
+        return self._parent() if self._parent else None
+
+    @parent.setter
+    def parent(self, item):
+        self._parent = weakref.ref(item) if item is not None else None
+
+    @staticmethod
+    def split_url(url: str) -> tuple:
+        """ Разбивает URL на части """
+        return tuple(part for part in (url or "").split("/") if part)
+
     def append(self, items):
         """
         Добавляет новый пункт в меню
@@ -68,10 +126,32 @@ class Menu(object):
             item.parent = self
             self.items_map.update(item.url_map)
             self.items_map.update(item.sub_menu.items_map)
+        self.reset()
+
+    def reset(self):
+        """ Сбрасывает скомпилированное меню (своё и всех родительских меню) после изменения структуры """
+        menu = self
+        while menu is not None:
+            menu._compiled = None
+            menu = menu.parent.parent if menu.parent else None
+
+    @property
+    def compiled(self) -> "CompiledMenu":
+        """ Скомпилированное меню """
+        if self._compiled is None:
+            self._compiled = CompiledMenu(self)
+        return self._compiled
+
+    def resolve(self, url: str):
+        """
+        Возвращает пункт меню с самым длинным URL, являющимся префиксом указанного URL
+        :param url: URL текущего положения
+        """
+        return self.compiled.resolve(url)
 
     def get_full(self, url=None) -> list:
         """ Возвращает структуру меню в виде списка словарей """
-        return [item.get_data(url) for item in self.items]
+        return self.compiled.get_full(self.resolve(url) if url else None)
 
     def get_sub_menu(self, url: str):
         """
@@ -79,7 +159,7 @@ class Menu(object):
         :param url: URL элемента меню, для которого необходимо вернуть подменю
         :return:
         """
-        menu_item = self.items_map.get(url, None)
+        menu_item = self.resolve(url)
         return menu_item.sub_menu if menu_item else Menu()
 
     @property
@@ -93,9 +173,7 @@ class Menu(object):
          :param url: URL элемента меню, для которого необходимо вернуть хлебные крошки
          :return:
          """
-        menu_item = self.items_map.get(url, None)
-        menu_item_parent_bc = menu_item.parent.breadcrumbs if menu_item else []
-        return (menu_item_parent_bc + [{"alias": menu_item.alias}]) if menu_item_parent_bc else []
+        return self.compiled.get_breadcrumbs(self.resolve(url))
 
     def get_data(self, url: str) -> dict:
         """
@@ -103,14 +181,92 @@ class Menu(object):
         :param url: URL текущего положения
         :return:
         """
+        return self.compiled.get_data(self.resolve(url))
+
+
+class CompiledMenu(object):
+    """ Скомпилированное меню: префиксное дерево URL всех пунктов и запомненные данные меню для каждого пункта
+    Возвращаемые структуры общие для всех запросов и не должны изменяться
+    :param menu: Меню
+    """
+    __slots__ = ("menu", "_trie", "_full", "_data", "_breadcrumbs")
+
+    def __init__(self, menu: Menu):
+        self.menu = menu
+        self._trie = {}
+        self._full = {}
+        self._data = {}
+        self._breadcrumbs = {}
+        for item in menu.items_map.values():
+            node = self._trie
+            for part in item.path:
+                node = node.setdefault(part, {})
+            node[None] = item
+
+    def resolve(self, url: str):
+        """
+        Возвращает пункт меню с самым длинным URL, являющимся префиксом указанного URL
+        :param url: URL текущего положения
+        """
+        node, found = self._trie, self._trie.get(None)
+        for part in Menu.split_url(url):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def get_full(self, active_item=None) -> list:
+        """ Возвращает структуру меню в виде списка словарей с отмеченными активными пунктами
+        :param active_item: Текущий пункт меню (результат resolve)
+        """
+        key = id(active_item) if active_item else None
+        if key not in self._full:
+            active = {active_item.path[:i] for i in range(len(active_item.path) + 1)} if active_item else set()
+            self._full[key] = [self._item_data(item, active) for item in self.menu.items]
+        return self._full[key]
+
+    def get_breadcrumbs(self, active_item=None) -> list:
+        """ Возвращает хлебные крошки для текущего пункта меню
+        :param active_item: Текущий пункт меню (результат resolve)
+        """
+        key = id(active_item) if active_item else None
+        if key not in self._breadcrumbs:
+            parent_breadcrumbs = active_item.parent.breadcrumbs if active_item and active_item.parent else []
+            self._breadcrumbs[key] = (parent_breadcrumbs + [{"alias": active_item.alias}]) if parent_breadcrumbs else []
+        return self._breadcrumbs[key]
+
+    def get_data(self, active_item=None) -> dict:
+        """ Возвращает все данные меню для текущего пункта
+        :param active_item: Текущий пункт меню (результат resolve)
+        """
+        key = id(active_item) if active_item else None
+        if key not in self._data:
+            sub_menu = active_item.sub_menu if active_item else Menu()
+            self._data[key] = {
+                "main_menu": self.get_full(active_item),
+                "sub_menu": sub_menu.get_full(active_item.url) if active_item else [],
+                "breadcrumbs": self.get_breadcrumbs(active_item)
+            }
+        return self._data[key]
+
+    @staticmethod
+    def _item_data(item: MenuItem, active: set) -> dict:
         return {
-            "main_menu": self.get_full(url),
-            "sub_menu": self.get_sub_menu(url).get_full(url),
-            "breadcrumbs": self.get_breadcrumbs(url)
+            "url": item.url,
+            "alias": item.alias,
+            "css_class": item.css_class,
+            "childs": item.sub_menu.get_full(),
+            "active": item.path in active
         }
 
 
 class Pager(object):
+    # Кэш количества записей по мапперу и ограничениям выборки
+    counts_cache = LRUCache(maxsize=1024, ttl=30)
+    # Допустимые значения для лимита
+    limits = [10, 30, 100]
+
     @property
     def limit(self):
         return self._limit
@@ -122,33 +278,63 @@ class Pager(object):
     def range(self, a, b):
         return list(range(a, b + 1))
 
-    def __init__(self, collection: CollectionModel, request: Request):
+    @classmethod
+    def count(cls, collection: CollectionModel) -> int:
+        """ Возвращает количество записей коллекции с учетом её ограничений
+        Результат кэшируется на counts_cache.ttl секунд или до записи в коллекцию через TableView
+        :param collection: Коллекция
+        """
+        mapper = get_mapper_class(collection.mapper)
+        return cls.counts_cache.get_or_set(
+            (get_contour(mapper), mapper, freeze(collection.boundaries)),
+            lambda: collection.count(collection.boundaries), tag=mapper
+        )
+
+    @classmethod
+    def invalidate(cls, mapper):
+        """ Сбрасывает закэшированное количество записей для всех выборок маппера
+        :param mapper: Класс или экземпляр маппера
+        """
+        cls.counts_cache.invalidate_tag(get_mapper_class(mapper))
+
+    @staticmethod
+    def requested(request: Request) -> tuple:
+        """ Возвращает запрошенные пользователем страницу и лимит
+        :param request: Запрос пользователя
+        :return: (страница, лимит)
+        """
+        try:
+            limit = int(request.get("limit", 10))
+        except ValueError:
+            limit = 10
+
+        try:
+            page = int(request.get("page", 1))
+        except ValueError:
+            page = 1
+        return page, limit
+
+    def __init__(self, collection: CollectionModel, request: Request, items_count: int=None):
         self._page = None
         self._pages = []
         self._pages_count = None
 
         self._limit = None
         self._limits = []
+        self._cursors = None
 
-        items_count = collection.count(collection.boundaries)
+        if items_count is None:
+            items_count = self.count(collection)
 
         # Допустимые значения для лимита
-        for limit in [10, 30, 100]:
+        for limit in self.limits:
             if items_count > limit:
                 self._limits.append(limit)
 
-        try:
-            self._limit = int(request.get("limit", 10))
-            if self._limit not in self._limits:
-                self._limit = 10
-        except ValueError:
+        self._page, self._limit = self.requested(request)
+        if self._limit not in self._limits:
             self._limit = 10
 
-        try:
-            self._page = int(request.get("page", 1))
-        except ValueError:
-            self._page = 1
-
         self._pages_count = ceil(items_count / self._limit)
 
         if self._page < 1:
@@ -159,6 +345,27 @@ class Pager(object):
 
         self.pages_factory()
 
+    @classmethod
+    def requested_limit(cls, request: Request) -> int:
+        """ Возвращает запрошенный пользователем лимит, если он допустим, иначе - лимит по умолчанию """
+        limit = cls.requested(request)[1]
+        return limit if limit in cls.limits else 10
+
+    @classmethod
+    def for_cursor(cls, page: int, limit: int, has_next: bool):
+        """ Пейджер постраничной навигации по курсору: количество записей не считается,
+        последней известной страницей считается следующая (если она есть)
+        :param page: Номер текущей страницы (из курсора)
+        :param limit: Лимит
+        :param has_next: Есть ли следующая страница
+        """
+        pager = cls.__new__(cls)
+        pager._page, pager._limit, pager._limits = max(page, 1), limit, list(cls.limits)
+        pager._pages_count = pager._page + 1 if has_next else pager._page
+        pager._pages, pager._cursors = [], None
+        pager.pages_factory()
+        return pager
+
     def pages_factory(self):
         if self._pages_count > 10:
             a = max(self._page - 2, 1)
@@ -173,8 +380,15 @@ class Pager(object):
         else:
             self._pages = list(range(1, self._pages_count + 1))
 
+    def set_cursors(self, prev_cursor: str=None, next_cursor: str=None):
+        """ Устанавливает курсоры соседних страниц для постраничной навигации по курсору
+        :param prev_cursor: Курсор предыдущей страницы
+        :param next_cursor: Курсор следующей страницы
+        """
+        self._cursors = {"prev": prev_cursor, "next": next_cursor}
+
     def represent(self):
-        return {
+        data = {
             "value": self._page,
             "values": self._pages,
             "max_value": self._pages_count,
@@ -183,6 +397,9 @@ class Pager(object):
                 "values": self._limits,
             }
         }
+        if self._cursors is not None:
+            data["cursors"] = self._cursors
+        return data
 
 class LinearPager(Pager):
     def pages_factory(self):
@@ -199,6 +416,154 @@ class LinearPager(Pager):
                 self._pages = ['...'] + self.range(max(self._pages_count - 8, 1), self._pages_count)
 
 
+class SearchIndexEntries(CollectionModel):
+    mapper = SearchIndexMapper
+
+
+class SearchIndexEntry(EntityModel):
+    mapper = SearchIndexMapper
+
+
+class SearchIndex(object):
+    """ Триграммный индекс колонок таблицы для поиска подстрок без LIKE '%...%' по всей таблице
+    Для использования маппер z9.core.web.mappers должен быть зарегистрирован в базе данных приложения.
+    Индекс таблицы (TableView.search_fields) обновляется при записях через z9 (listen_writes);
+    после записей в обход z9 индекс нужно перестроить (migrate.py --reindex)
+    :param collection: Имя индексируемой коллекции
+    :param fields: Список индексируемых свойств
+    :param table: Класс таблицы, из которой выбираются значения строк, измененных update коллекции
+    """
+    token_size = 3
+    # Если кандидатов больше, индекс не используется (запрос IN (...) был бы дороже LIKE)
+    max_candidates = 10000
+    # Максимальное количество строк индекса (или ключей) в одном запросе INSERT/DELETE
+    batch_size = 1000
+
+    def __init__(self, collection: str, fields: list, table: type=None):
+        self.collection = collection
+        self.fields = fields
+        self.table = table
+
+    @property
+    def db(self):
+        return SearchIndexMapper.pool.db
+
+    @classmethod
+    def tokens(cls, value) -> set:
+        """ Возвращает множество триграмм значения
+        :param value: Индексируемое значение
+        """
+        value = str(value).lower() if value is not None else ""
+        return {value[i:i + cls.token_size] for i in range(len(value) - cls.token_size + 1)}
+
+    def index(self, row_id, values: dict):
+        """ Перестраивает индекс одной строки таблицы
+        :param row_id: Первичный ключ строки
+        :param values: Значения индексируемых свойств {свойство: значение}
+        """
+        self.index_many([(row_id, values)])
+
+    def index_many(self, items: list, replace: bool=True):
+        """ Перестраивает индекс нескольких строк таблицы пакетными запросами
+        :param items: Список пар (первичный ключ строки, {свойство: значение})
+        :param replace: Удалить прежние записи индекса этих строк
+        """
+        rows = [
+            (self.collection, field, str(row_id), token)
+            for row_id, values in items for field in self.fields for token in sorted(self.tokens(values.get(field)))
+        ]
+        with transaction(SearchIndexMapper.pool):
+            if replace:
+                self.remove([row_id for row_id, values in items])
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                self.db.execute_raw(
+                    "INSERT INTO `SearchIndex` (`Collection`, `Field`, `RowID`, `Token`) VALUES %s" % ", ".join(
+                        ["(%s, %s, %s, %s)"] * len(batch)
+                    ),
+                    [value for row in batch for value in row]
+                )
+
+    def remove(self, row_ids: list):
+        """ Удаляет строки таблицы из индекса
+        :param row_ids: Первичные ключи строк
+        """
+        row_ids = [str(row_id) for row_id in row_ids]
+        for i in range(0, len(row_ids), self.batch_size):
+            batch = row_ids[i:i + self.batch_size]
+            self.db.execute_raw(
+                "DELETE FROM `SearchIndex` WHERE `Collection` = %%s AND `RowID` IN (%s)" % ", ".join(["%s"] * len(batch)),
+                [self.collection] + batch
+            )
+
+    def index_keys(self, row_ids: list):
+        """ Перестраивает индекс строк таблицы по первичным ключам
+        Значения индексируемых свойств выбираются порциями по batch_size ключей, сущности не создаются
+        :param row_ids: Первичные ключи строк
+        """
+        table = self.table()
+        primary = table.mapper.primary.name()
+        fields = [primary] + [field for field in self.fields if field != primary]
+        for i in range(0, len(row_ids), self.batch_size):
+            self.index_many([
+                (row[primary], {field: row.get(field) for field in self.fields})
+                for row in table.generate_rows(fields, {primary: ("in", row_ids[i:i + self.batch_size])})
+            ])
+
+    def written(self, saved: list, deleted: list, updated: list):
+        """ Обработчик записей через маппер индексируемой таблицы (listen_writes)
+        :param saved: Сохраненные сущности
+        :param deleted: Первичные ключи удаленных записей
+        :param updated: Первичные ключи записей, измененных update коллекции
+        """
+        if deleted:
+            self.remove(deleted)
+        if saved:
+            self.index_many([
+                (model.primary.get_value(deep=True), {field: getattr(model, field) for field in self.fields})
+                for model in saved
+            ])
+        if updated:
+            self.index_keys(updated)
+
+    def search(self, field: str, value: str):
+        """ Возвращает первичные ключи строк, в которых значение свойства может содержать подстроку value
+        Кандидаты необходимо дополнительно проверить исходным условием (LIKE), но уже только среди них.
+        Пересечение списков строк по триграммам вычисляется в базе данных одним запросом
+        :param field: Свойство
+        :param value: Искомая подстрока
+        :return: Множество ключей или None, если индекс для такого запроса неприменим
+        """
+        tokens = self.tokens(value)
+        if field not in self.fields or not tokens:
+            return None
+        tokens = sorted(tokens)
+        found = raw_rows(self.db.execute_raw(
+            "SELECT `RowID` FROM `SearchIndex` WHERE `Collection` = %%s AND `Field` = %%s AND `Token` IN (%s) "
+            "GROUP BY `RowID` HAVING COUNT(DISTINCT `Token`) = %%s LIMIT %%s" % ", ".join(["%s"] * len(tokens)),
+            [self.collection, field] + tokens + [len(tokens), self.max_candidates + 1]
+        ))
+        if len(found) > self.max_candidates:
+            return None
+        return {row[0] for row in found}
+
+    def rebuild(self, table: "TableView") -> int:
+        """ Полностью перестраивает индекс таблицы (используется для заполнения индекса существующих данных)
+        :param table: Экземпляр таблицы
+        :return: Количество проиндексированных строк
+        """
+        self.db.execute_raw("DELETE FROM `SearchIndex` WHERE `Collection` = %s", [self.collection])
+        indexed, batch = 0, []
+        for row_id, values in table.iter_all_rows(properties=self.fields):
+            batch.append((row_id, dict(zip(self.fields, values))))
+            if len(batch) == self.batch_size:
+                self.index_many(batch, replace=False)
+                indexed, batch = indexed + len(batch), []
+        if batch:
+            self.index_many(batch, replace=False)
+        return indexed + len(batch)
+
+
 class TableView(CollectionModel):
     """ Класс для представления коллекции в виде структуры данных пригодной для использования в шаблонизаторе """
     template = ""
@@ -209,7 +574,38 @@ class TableView(CollectionModel):
     sort = []
     filter_autocomplete = []
     filter_select = []
+    prefetch_related = []
+
+    # Строки только для чтения: выбираются лишь колонки properties и первичный ключ, без создания сущностей
+    lightweight_rows = False
+
+    # Постраничная навигация по курсору (seek по колонке сортировки и первичному ключу) вместо skip/limit,
+    # используется, если в запросе передан курсор
+    keyset_pagination = False
+
+    # Связи (Prefetch), данные которых fetch_one возвращает вместе с записью
+    fetch_related = []
+
+    # Свойства, для фильтров filter_autocomplete по которым используется поисковый индекс (SearchIndex)
+    search_fields = []
 
+    # Значения и количество записей для колонок filter_select (фасеты) в заголовке таблицы
+    select_facets = False
+    facets_cache = LRUCache(maxsize=1024, ttl=60)
+
+    # Максимальное количество ключей в одном запросе при пакетных операциях
+    bulk_chunk_size = 1000
+
+    # Размер порции строк при выгрузке всей коллекции
+    export_chunk_size = 5000
+    export_content_types = {
+        "csv": "text/csv; charset=utf-8",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    }
+
+    # Выполнять подсчет записей для пейджера параллельно с выборкой страницы (на отдельном соединении)
+    parallel_count = False
+    count_executor = ThreadPoolExecutor(max_workers=8)
 
     record_exists_exception = CommonException("Row exists already")
     record_not_found_exception = CommonException("Row not found")
@@ -229,18 +625,252 @@ class TableView(CollectionModel):
         """ Возвращает строки таблицы
         :return:
         """
+        if self.lightweight_rows:
+            return [[pk, OrderedDict(zip(self.properties, values))] for pk, values in self.iter_rows(sort, skip, limit)]
+
+        rows = []
+        for item in self.get_items(self.boundaries, params=self._rows_params(sort, skip, limit)):
+            rows.append([item.primary.get_value(deep=True), item.stringify(self.properties)])
+
+        return rows
+
+    def iter_rows(self, sort=None, skip=0, limit=None, bounds: dict=None):
+        """ Лениво возвращает строки таблицы в виде кортежей (первичный ключ, (значения колонок properties))
+        Из базы данных выбираются только колонки properties и первичный ключ, сущности не создаются
+        :param sort: Сортировка
+        :param skip: Количество пропускаемых строк
+        :param limit: Количество строк
+        :param bounds: Ограничения выборки (по умолчанию - ограничения таблицы)
+        """
+        primary = self.mapper.primary.name()
+        fields = [primary] + [p for p in self.properties if p != primary]
+        bounds = self.boundaries if bounds is None else bounds
+        for row in self.generate_rows(fields, bounds, self._rows_params(sort, skip, limit)):
+            yield row[primary], tuple(self._plain_value(row.get(p)) for p in self.properties)
+
+    def _rows_params(self, sort, skip=0, limit=None) -> dict:
         params = self.params.copy()
         if sort:
             params.update({'order': self._orders.get(sort)})
 
         if limit and limit > 0:
             params.update({"skip": skip, "limit": limit})
+        return params
 
-        rows = []
-        for item in self.get_items(self.boundaries, params=params):
-            rows.append([item.primary.get_value(deep=True), item.stringify(self.properties)])
+    @staticmethod
+    def _plain_value(value):
+        """ Приводит значение колонки к виду, пригодному для шаблонизатора (даты, десятичные числа и т.п. - к строке) """
+        return value if value is None or isinstance(value, (str, int, float, bool)) else str(value)
 
-        return rows
+    def seek(self, sort, limit: int, cursor: str=None) -> tuple:
+        """ Возвращает строки таблицы, следующие за курсором (или предшествующие ему)
+        Вместо пропуска skip строк используется условие по колонке сортировки и первичному ключу,
+        поэтому время выборки не зависит от глубины страницы
+        :param sort: Сортировка
+        :param limit: Количество строк
+        :param cursor: Курсор, полученный из pager.cursors (None - первая страница)
+        :return: (строки, (курсор предыдущей страницы, курсор следующей страницы), номер страницы)
+        """
+        backwards, values, page = self._decode_cursor(sort, cursor)
+        prop, direction = self._orders.get(sort) or (None, "ASC")
+        primary = self.mapper.primary.name()
+        if backwards:
+            direction = "DESC" if direction == "ASC" else "ASC"
+
+        if prop == primary:
+            prop = None
+
+        bounds = dict(self.boundaries)
+        if values:
+            bounds.update(self._seek_boundaries(prop, direction, *values))
+
+        params = self.params.copy()
+        params.update({"order": self._seek_order(prop, direction), "limit": limit + 1})
+        items = list(self.get_items(bounds, params=params))
+        has_more = len(items) > limit
+        items = items[:limit]
+        if backwards:
+            items.reverse()
+
+        rows = [[item.primary.get_value(deep=True), item.stringify(self.properties)] for item in items]
+        has_prev, has_next = (has_more, values is not None) if backwards else (values is not None, has_more)
+        return rows, (
+            self._encode_cursor(sort, items[0], True, page - 1) if items and has_prev else None,
+            self._encode_cursor(sort, items[-1], False, page + 1) if items and has_next else None
+        ), page
+
+    def _seek_boundaries(self, prop, direction: str, sort_value, primary_value) -> dict:
+        """ Условие выборки строк, следующих в порядке сортировки за строкой с указанными значениями
+        Сравнение с NULL не выполняется, поэтому NULL в колонке сортировки обрабатывается явно:
+        NULL считается меньше любого значения (как при сортировке в MySQL) - такие строки идут первыми при ASC
+        и последними при DESC
+        """
+        op = "gt" if direction == "ASC" else "lt"
+        primary = self.mapper.primary.name()
+        if prop is None:
+            return {primary: (op, primary_value)}
+        if sort_value is None:
+            same = {prop: None, primary: (op, primary_value)}
+            return {"or": [same, {prop: ("ne", None)}]} if direction == "ASC" else same
+        conditions = [{prop: (op, sort_value)}, {prop: sort_value, primary: (op, primary_value)}]
+        if direction == "DESC":
+            conditions.append({prop: None})
+        return {"or": conditions}
+
+    def _seek_order(self, prop, direction: str):
+        """ Порядок сортировки для seek: колонка сортировки и первичный ключ для однозначности """
+        primary = self.mapper.primary.name()
+        return [(prop, direction), (primary, direction)] if prop else (primary, direction)
+
+    def _encode_cursor(self, sort, item: EntityModel, backwards: bool, page: int) -> str:
+        prop = (self._orders.get(sort) or (None,))[0]
+        value = item.__getattribute__(prop) if prop else None
+        if isinstance(value, EntityModel):
+            value = value.primary.get_value(deep=True)
+        if isinstance(value, EmbeddedObject):
+            value = value.get_value()
+        data = json.dumps([sort, backwards, value, item.primary.get_value(deep=True), page], default=str)
+        return urlsafe_b64encode(data.encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(sort, cursor: str) -> tuple:
+        """ Возвращает направление, значения курсора и номер страницы;
+        курсор другой сортировки или поврежденный игнорируется (первая страница)
+        """
+        try:
+            cursor_sort, backwards, sort_value, primary_value, page = json.loads(
+                urlsafe_b64decode(cursor.encode()).decode()
+            )
+            page = int(page)
+        except (ValueError, TypeError, AttributeError):
+            return False, None, 1
+        if cursor_sort != sort:
+            return False, None, 1
+        return bool(backwards), (sort_value, primary_value), page
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.search_fields and getattr(cls, "mapper", None) is not None:
+            index = SearchIndex(get_mapper_class(cls.mapper).__name__, cls.search_fields, cls)
+            listen_writes(cls.mapper, ("search_index", tuple(cls.search_fields)), index.written)
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """ Поисковый индекс колонок search_fields """
+        return SearchIndex(get_mapper_class(self.mapper).__name__, self.search_fields, type(self))
+
+    def reindex(self, model: EntityModel):
+        """ Обновляет запись в поисковом индексе после сохранения
+        (сущности z9 индексируются при сохранении через listen_writes)
+        :param model: Сохраненная сущность
+        """
+        if self.search_fields:
+            self.search_index.index(
+                model.primary.get_value(deep=True), {field: getattr(model, field) for field in self.search_fields}
+            )
+
+    @classmethod
+    def rebuild_search_index(cls) -> int:
+        """ Заполняет поисковый индекс таблицы по существующим данным
+        :return: Количество проиндексированных строк
+        """
+        table = cls()
+        return table.search_index.rebuild(table)
+
+    def _written(self, saved: list=None, deleted: list=None):
+        """ Обновляет производные данные таблицы (кэши количества записей и фасетов, поисковый индекс) после записи
+        Удаления и сохранения сущностей z9 попадают в поисковый индекс через listen_writes
+        :param saved: Сохраненные сущности
+        :param deleted: Первичные ключи удаленных записей
+        """
+        LinearPager.invalidate(self.mapper)
+        self.facets_cache.invalidate_tag(get_mapper_class(self.mapper))
+        for model in saved or []:
+            if not isinstance(model, Z9EntityModel):
+                self.reindex(model)
+
+    def facets(self) -> dict:
+        """ Возвращает возможные значения колонок filter_select с количеством записей для каждого значения
+        Учитываются все текущие ограничения таблицы, кроме фильтра по самой колонке.
+        Результаты кэшируются на facets_cache.ttl секунд или до записи в таблицу
+        :return: {свойство: [{"value": значение, "count": количество}, ...]}
+        """
+        return {prop: self.facet(prop) for prop in self._facet_properties()}
+
+    def facet(self, prop: str) -> list:
+        """ Возвращает значения колонки с количеством записей для каждого значения
+        Подсчет выполняется в базе данных (SELECT колонка, COUNT(*) ... GROUP BY колонка); если ограничения
+        таблицы нельзя выразить простым условием по колонкам, значения подсчитываются по строкам выборки
+        :param prop: Свойство
+        """
+        mapper = get_mapper_class(self.mapper)
+        bounds = {key: value for key, value in self.boundaries.items() if key != prop}
+
+        def count():
+            query = self._facet_query(prop, bounds)
+            if query is not None:
+                counter = {}
+                for value, n in raw_rows(self.mapper.pool.db.execute_raw(*query)):
+                    value = self._plain_value(value)
+                    counter[value] = counter.get(value, 0) + int(n)
+            else:
+                logger.warning(
+                    "%s: facet %s is counted over all selected rows, bounds are not column conditions",
+                    self.__class__.__name__, prop
+                )
+                counter = Counter(self._plain_value(row.get(prop)) for row in self.generate_rows([prop], bounds))
+            return [
+                {"value": value, "count": n}
+                for value, n in sorted(counter.items(), key=lambda item: ("" if item[0] is None else str(item[0])))
+            ]
+        return self.facets_cache.get_or_set((get_contour(mapper), mapper, prop, freeze(bounds)), count, tag=mapper)
+
+    def _facet_query(self, prop: str, bounds: dict):
+        """ Запрос подсчета записей по значениям колонки (SQL и параметры) или None, если свойство или ограничения
+        не сводятся к колонкам таблицы. Поддерживаются условия равенства, ("in", [...]) и ("match", шаблон)
+        """
+        column = get_column_name(self.mapper, prop)
+        if column is None:
+            return None
+        conditions, params = [], []
+        for key, value in bounds.items():
+            condition = self._column_condition(get_column_name(self.mapper, key), value)
+            if condition is None:
+                return None
+            conditions.append(condition[0])
+            params.extend(condition[1])
+        sql = "SELECT `%s`, COUNT(*) FROM `%s`%s GROUP BY `%s`" % (
+            column, get_table_name(self.mapper), " WHERE " + " AND ".join(conditions) if conditions else "", column
+        )
+        return sql, params
+
+    @staticmethod
+    def _column_condition(column, value):
+        """ Условие SQL по колонке (SQL и параметры) для значения ограничения или None, если ограничение не поддерживается """
+        if column is None:
+            return None
+        if value is None:
+            return "`%s` IS NULL" % column, []
+        if isinstance(value, (str, int, float, bool)):
+            return "`%s` = %%s" % column, [value]
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == "in" and isinstance(value[1], (list, tuple)):
+            values = [v for v in value[1] if v is None or isinstance(v, (str, int, float, bool))]
+            if len(values) != len(value[1]):
+                return None
+            return ("`%s` IN (%s)" % (column, ", ".join(["%s"] * len(values))), values) if values else ("0", [])
+        if isinstance(value, tuple) and len(value) == 2 and value[0] == "match" and isinstance(value[1], str):
+            return "`%s` LIKE %%s" % column, [value[1]]
+        return None
+
+    def _facet_properties(self) -> list:
+        """ Свойства колонок с фильтром filter_select """
+        return list(filter(None, (self._facet_property(key) for key in range(len(self.properties)))))
+
+    def _facet_property(self, key: int):
+        """ Свойство колонки key с фильтром filter_select (в filter_select можно указать имя свойства фильтра) """
+        if len(self.filter_select) <= key or self.filter_select[key] is None:
+            return None
+        return self.filter_select[key] if isinstance(self.filter_select[key], str) else self.properties[key]
 
     def set_sub_boundaries(self, sub_boundaries: dict):
         """ Устанавливаеь дополнительные ограничения на таблицу (Что-то вроде фильтра или поиска по таблице)
@@ -248,26 +878,41 @@ class TableView(CollectionModel):
         """
         self.boundaries.update(sub_boundaries)
 
-    def represent(self, request: Request=None,
-                  show_checkboxes=True,
-                  show_add_button=True,
-                  show_edit_button=True,
-                  show_delete_button=True
-    ):
-        """ Возвращает коллекцию в виде пригодном для шаблонизатора """
-
+    def apply_filters(self, request: Request):
+        """ Применяет к таблице фильтры из запроса пользователя
+        :param request: Запрос пользователя
+        :return: Выбранная пользователем сортировка
+        """
         sort = request.get('sort', None)\
             if request.get('sort', None) in self._orders\
             else None
 
+        candidates = None
         for key,value in request.get("filter_autocomplete", {}).items():
-            self.set_sub_boundaries({key: ("match", "%" + value + "%")})
+            self.set_sub_boundaries({key: ("match", "%" + escape_like(value) + "%")})
+            found = self.search_index.search(key, value) if self.search_fields else None
+            if found is not None:
+                candidates = found if candidates is None else candidates & found
+        if candidates is not None:
+            self.set_sub_boundaries({self.mapper.primary.name(): ("in", list(candidates) or [None])})
 
         for key,value in request.get("filter_select", {}).items():
             if value:
                 self.set_sub_boundaries({key: value})
 
-        pager = LinearPager(self, request)
+        return sort
+
+    def represent(self, request: Request=None,
+                  show_checkboxes=True,
+                  show_add_button=True,
+                  show_edit_button=True,
+                  show_delete_button=True
+    ):
+        """ Возвращает коллекцию в виде пригодном для шаблонизатора """
+
+        sort = self.apply_filters(request)
+        pager, rows = self.paginate(request, sort)
+        facets = self.facets() if self.select_facets else {}
 
         return {
             "template": self.template,
@@ -276,12 +921,13 @@ class TableView(CollectionModel):
                 "title": self.header[key],
                 "sort": {"asc": self.sort[key] + "-asc", "desc": self.sort[key] + "-desc"} if len(self.sort) >= key + 1 and self.sort[key] is not None else None,
                 "filter_autocomplete": self.filter_autocomplete[key] if len(self.filter_autocomplete) > key and self.filter_autocomplete[key] is not None else None,
-                "filter_select": self.filter_select[key] if len(self.filter_select) > key and self.filter_select[key] is not None else None
+                "filter_select": self.filter_select[key] if len(self.filter_select) > key and self.filter_select[key] is not None else None,
+                "facets": facets.get(self._facet_property(key))
             }
                 for key, p in enumerate(self.properties)
 
             ],
-            "rows": self.rows(sort, pager.offset, pager.limit),
+            "rows": rows,
             "sort": sort,
             "pager": pager.represent(),
             "show_checkboxes": show_checkboxes,
@@ -290,6 +936,134 @@ class TableView(CollectionModel):
             "show_delete_button": show_delete_button,
         }
 
+    def iter_all_rows(self, sort=None, properties: list=None):
+        """ Лениво возвращает все строки таблицы в виде кортежей (первичный ключ, (значения колонок properties))
+        Строки выбираются порциями по export_chunk_size с помощью seek, поэтому расход памяти не зависит от размера выборки
+        :param sort: Сортировка
+        :param properties: Выбираемые свойства (по умолчанию - колонки таблицы)
+        """
+        properties = self.properties if properties is None else properties
+        prop, direction = self._orders.get(sort) or (None, "ASC")
+        primary = self.mapper.primary.name()
+        if prop == primary:
+            prop = None
+        fields = [primary] + [p for p in properties if p != primary]
+        if prop and prop not in fields:
+            fields.append(prop)
+
+        params = self.params.copy()
+        params.update({"order": self._seek_order(prop, direction), "limit": self.export_chunk_size})
+        values = None
+        while True:
+            bounds = dict(self.boundaries)
+            if values:
+                bounds.update(self._seek_boundaries(prop, direction, *values))
+            fetched = 0
+            for row in self.generate_rows(fields, bounds, params):
+                fetched += 1
+                values = (row.get(prop) if prop else None, row[primary])
+                yield row[primary], tuple(self._plain_value(row.get(p)) for p in properties)
+            if fetched < self.export_chunk_size:
+                break
+
+    def export(self, request: Request):
+        """ Выгружает всю коллекцию с учетом фильтров и сортировки из запроса в CSV или XLSX (параметр format)
+        Возвращает генератор байтовых фрагментов, который контроллер отдает в качестве тела ответа,
+        тип содержимого для формата - в export_content_types
+        :param request: Запрос пользователя
+        """
+        export_format = request.get("format", "csv")
+        if export_format not in self.export_content_types:
+            raise CommonException("Unknown export format: %s" % export_format)
+        if export_format == "xlsx":
+            # Проверяем зависимость до начала отдачи ответа, иначе ошибка возникнет посреди потока
+            try:
+                import xlsxwriter
+            except ImportError:
+                raise CommonException("XLSX export requires the xlsxwriter package")
+        sort = self.apply_filters(request)
+        return self._export_stream(export_format, self.iter_all_rows(sort))
+
+    def _export_stream(self, export_format: str, rows):
+        started, exported = time.time(), 0
+
+        def counted():
+            nonlocal exported
+            for row in rows:
+                exported += 1
+                yield row
+
+        yield from (self._export_xlsx if export_format == "xlsx" else self._export_csv)(counted())
+        elapsed = time.time() - started
+        logger.info(
+            "%s: exported %d rows to %s in %.3f sec (%.0f rows/sec)",
+            self.__class__.__name__, exported, export_format, elapsed, exported / elapsed if elapsed else 0
+        )
+
+    def _export_csv(self, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        # BOM, чтобы Excel правильно определил кодировку
+        buffer.write("\ufeff")
+        writer.writerow(self.header)
+        for i, (pk, values) in enumerate(rows, 1):
+            writer.writerow(["" if v is None else v for v in values])
+            if i % self.export_chunk_size == 0:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def _export_xlsx(self, rows):
+        import xlsxwriter
+        with tempfile.TemporaryFile() as f:
+            # constant_memory: строки сбрасываются на диск по мере записи
+            workbook = xlsxwriter.Workbook(f, {"constant_memory": True, "in_memory": False})
+            sheet = workbook.add_worksheet()
+            sheet.write_row(0, 0, self.header)
+            for i, (pk, values) in enumerate(rows, 1):
+                sheet.write_row(i, 0, values)
+            workbook.close()
+            f.seek(0)
+            yield from iter(lambda: f.read(65536), b"")
+
+    def paginate(self, request: Request, sort=None) -> tuple:
+        """ Возвращает пейджер и строки текущей страницы
+        При включенном parallel_count количество записей считается параллельно с выборкой страницы;
+        если пейджер скорректирует запрошенные страницу или лимит, страница будет выбрана повторно
+        :param request: Запрос пользователя
+        :param sort: Сортировка
+        :return: (пейджер, строки)
+        """
+        # Первая страница выбирается без курсора, но уже отдает курсор следующей.
+        # Количество записей при навигации по курсору не считается: номер страницы передается в курсоре
+        if self.keyset_pagination and (request.get("cursor", None) or LinearPager.requested(request)[0] <= 1):
+            limit = LinearPager.requested_limit(request)
+            rows, cursors, page = self.seek(sort, limit, request.get("cursor"))
+            pager = LinearPager.for_cursor(page, limit, cursors[1] is not None)
+            pager.set_cursors(*cursors)
+            return pager, rows
+
+        if not self.parallel_count:
+            pager = LinearPager(self, request)
+            return pager, self.rows(sort, pager.offset, pager.limit)
+
+        def count():
+            try:
+                return LinearPager.count(self)
+            finally:
+                self.mapper.pool.release()
+
+        # Подсчет выполняется в контексте запроса, чтобы учитывалась привязка запроса к основному серверу
+        items_count = self.count_executor.submit(contextvars.copy_context().run, count)
+        page, limit = LinearPager.requested(request)
+        offset = (max(page, 1) - 1) * limit
+        rows = self.rows(sort, offset, limit)
+        pager = LinearPager(self, request, items_count=items_count.result())
+        if (pager.offset, pager.limit) != (offset, limit):
+            rows = self.rows(sort, pager.offset, pager.limit)
+        return pager, rows
+
     def create(self, request: Request):
         """ Создание новой записи если её ещё не существует """
         data = dict(request.items())
@@ -298,6 +1072,7 @@ class TableView(CollectionModel):
         if model.mapper.primary.exists() and self.count(model.primary.to_dict()):
             raise self.record_exists_exception
         model.save()
+        self._written(saved=[model])
 
     # noinspection PyMethodOverriding
     def update(self, request: Request):
@@ -306,29 +1081,173 @@ class TableView(CollectionModel):
         if model is None:
             raise self.record_not_found_exception
         model.load_from_array(dict(request.items())).save()
+        self._written(saved=[model])
 
     # noinspection PyMethodOverriding
     def delete(self, request: Request):
-        """ Удаление нескольких записей """
+        """ Удаление нескольких записей (порциями по bulk_chunk_size ключей) """
         pkeys = request.get("row_id")
         if not isinstance(pkeys, list):
             pkeys = [pkeys]
-        super().delete({self.mapper.primary.name(): ("in", pkeys)})
+        for chunk in self._chunks(pkeys):
+            self._delete_keys(chunk)
+        self._written(deleted=pkeys)
+
+    def create_many(self, request: Request) -> list:
+        """ Пакетное создание записей из списка rows
+        Существующие записи определяются одним запросом, новые сохраняются в одной транзакции.
+        Записи сохраняются по одной (save сущности: связи, встроенные списки, автоинкрементный ключ),
+        а не одним INSERT на несколько строк; ошибка строки откатывает только эту строку (см. _save_row)
+        :return: Результат для каждой строки: created, exists или error
+        """
+        models = [self.get_new_item(data) for data in request.get("rows", [])]
+        keys = [model.primary.get_value(deep=True) if model.mapper.primary.exists() else None for model in models]
+        existing = self._existing_keys(list(filter(lambda k: k is not None, keys)))
+
+        results, saved = [], []
+        with transaction(self.mapper.pool):
+            for i, (model, key) in enumerate(zip(models, keys)):
+                if key is not None and self._key(key) in existing:
+                    results.append({"row": i, "result": "exists", "row_id": key})
+                    continue
+                error = self._save_row(model)
+                if error is not None:
+                    results.append({"row": i, "result": "error", "message": error})
+                    continue
+                key = model.primary.get_value(deep=True)
+                existing[self._key(key)] = key
+                saved.append(model)
+                results.append({"row": i, "result": "created", "row_id": key})
+        self._written(saved=saved)
+        return results
+
+    def update_many(self, request: Request) -> list:
+        """ Пакетное обновление записей из списка rows (каждая строка содержит row_id)
+        Записи загружаются запросами IN (...), изменения сохраняются в одной транзакции
+        :return: Результат для каждой строки: updated, not_found или error
+        """
+        rows = request.get("rows", [])
+        primary = self.mapper.primary.name()
+        models = {}
+        for chunk in self._chunks([row.get("row_id") for row in rows]):
+            for model in self.get_items({primary: ("in", chunk)}):
+                models[self._key(model.primary.get_value(deep=True))] = model
+
+        results, saved = [], []
+        with transaction(self.mapper.pool):
+            for i, row in enumerate(rows):
+                model = models.get(self._key(row.get("row_id")))
+                if model is None:
+                    results.append({"row": i, "result": "not_found", "row_id": row.get("row_id")})
+                    continue
+                try:
+                    model.load_from_array({k: v for k, v in row.items() if k != "row_id"})
+                except CommonException as err:
+                    results.append({"row": i, "result": "error", "row_id": row.get("row_id"), "message": str(err)})
+                    continue
+                error = self._save_row(model)
+                if error is not None:
+                    results.append({"row": i, "result": "error", "row_id": row.get("row_id"), "message": error})
+                    continue
+                saved.append(model)
+                results.append({"row": i, "result": "updated", "row_id": row.get("row_id")})
+        self._written(saved=saved)
+        return results
+
+    def delete_many(self, request: Request) -> list:
+        """ Пакетное удаление записей по списку row_id порциями по bulk_chunk_size ключей
+        :return: Результат для каждого ключа: deleted или not_found
+        """
+        pkeys = request.get("row_id", [])
+        if not isinstance(pkeys, list):
+            pkeys = [pkeys]
+        existing = self._existing_keys(pkeys)
+        for chunk in self._chunks(list(existing.values())):
+            self._delete_keys(chunk)
+        self._written(deleted=list(existing.values()))
+        return [{"row_id": key, "result": "deleted" if self._key(key) in existing else "not_found"} for key in pkeys]
+
+    def _delete_keys(self, keys: list):
+        """ Удаляет записи с указанными первичными ключами """
+        super().delete({self.mapper.primary.name(): ("in", keys)})
+
+    def _save_row(self, model: EntityModel):
+        """ Сохраняет сущность пакетной операции под точкой сохранения транзакции
+        Ошибка сохранения - как ошибка модели, так и ошибка базы данных - откатывает только эту строку
+        :return: Текст ошибки или None
+        """
+        db = self.mapper.pool.db
+        db.execute_raw("SAVEPOINT bulk_row")
+        try:
+            model.save()
+            # Сущности z9 внутри unit_of_work сохраняются отложенно, а ошибку нужно получить для этой строки
+            flush()
+        except Exception as err:
+            if not isinstance(err, CommonException):
+                logger.warning("%s: bulk row was not saved", self.__class__.__name__, exc_info=True)
+            db.execute_raw("ROLLBACK TO SAVEPOINT bulk_row")
+            return str(err)
+        db.execute_raw("RELEASE SAVEPOINT bulk_row")
+        return None
+
+    def _existing_keys(self, keys: list) -> dict:
+        """ Возвращает существующие в таблице первичные ключи из переданного списка
+        :return: {нормализованный ключ (_key): ключ в том виде, в котором он хранится в базе данных}
+        """
+        primary = self.mapper.primary.name()
+        existing = {}
+        for chunk in self._chunks(keys):
+            for row in self.generate_rows([primary], {primary: ("in", chunk)}):
+                existing[self._key(row[primary])] = row[primary]
+        return existing
+
+    @staticmethod
+    def _key(value):
+        """ Нормализует первичный ключ для сравнения ключей из запроса (строки) с ключами из базы данных """
+        return str(value) if value is not None else None
+
+    def _chunks(self, keys: list):
+        keys = list(dict.fromkeys(keys))
+        for i in range(0, len(keys), self.bulk_chunk_size):
+            yield keys[i:i + self.bulk_chunk_size]
 
     # noinspection PyMethodOverriding
-    def fetch_one(self, request: Request):
-        model = self.get_item({self.mapper.primary.name(): request.get("row_id")})
-        if not model:
+    def fetch_one(self, request: Request, relations: list=None):
+        """ Возвращает данные одной записи для формы редактирования
+        Значения свойств, хранящихся в колонках таблицы (в том числе внешние ключи свойств-ссылок), читаются
+        из строки таблицы одним запросом, связанные сущности не загружаются.
+        Связи из relations (по умолчанию - fetch_related) загружаются пакетно
+        :param request: Запрос пользователя
+        :param relations: Список связей (Prefetch), данные которых нужно вернуть вместе с записью
+        """
+        primary = self.mapper.primary.name()
+        properties = [p for p in self.mapper.get_properties() if get_column_name(self.mapper, p)]
+        fields = [primary] + [p for p in properties if p != primary]
+        row = next(iter(self.generate_rows(fields, {primary: request.get("row_id")}, {"limit": 1})), None)
+        if not row:
             raise self.record_not_found_exception
 
-        data = model.stringify(self.mapper.get_properties())
-        for p in self.mapper.get_properties():
-            attr = model.__getattribute__(p)
+        # Значения форматируются так же, как в stringify сущности, ссылки возвращаются значением внешнего ключа
+        # (ссылки определяются по описанию полей маппера, чтобы не загружать связанные сущности)
+        model = self.get_new_item().load_from_array(dict(row), consider_as_unchanged=True)
+        links = [p for p in properties if is_link_property(self.mapper, p)]
+        data = model.stringify([p for p in properties if p not in links])
+        for p in properties:
+            if p in links:
+                data[p] = self._plain_value(row.get(p))
+            elif isinstance(getattr(model, p), EmbeddedObject):
+                data[p] = getattr(model, p).get_value()
 
-            if isinstance(attr, EmbeddedObject):
-                data[p] = attr.get_value()
-            if isinstance(attr, EntityModel):
-                data[p] = attr.primary.get_value(deep=True)
+        relations = self.fetch_related if relations is None else relations
+        if relations:
+            # Связи загружаются для уже выбранной записи, внешние ключи ссылок берутся из её строки
+            prefetch([model], *relations, rows=[row])
+            for relation in relations:
+                related = getattr(model, relation.prop)
+                if isinstance(related, EntityModel):
+                    data[relation.prop] = related.stringify(related.mapper.get_properties())
+                elif isinstance(related, list):
+                    data[relation.prop] = [entity.stringify(entity.mapper.get_properties()) for entity in related]
 
-        data["row_id"] = model.primary.get_value(deep=True)
+        data["row_id"] = row[primary]
         return data
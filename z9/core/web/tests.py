@@ -1,7 +1,11 @@
 """ Тестирование моделей UI """
 from unittest import TestCase
 
-from z9.core.web.models import Menu, MenuItem
+from mapex import EntityModel
+
+from z9.core.models import Application, ConnectionPool, Contours, Prefetch
+from z9.core.web.mappers import SearchIndexMapper
+from z9.core.web.models import Menu, MenuItem, SearchIndex, TableView, LinearPager
 
 
 class MenuTest(TestCase):
@@ -74,4 +78,395 @@ class MenuTest(TestCase):
 
     def test_get_data(self):
         """ Объект меню возвращает словарь, содеражащий все эелемент меню """
-        self.assertCountEqual(["breadcrumbs", "main_menu", "sub_menu"], self.menu.get_data("doesn't matter"))
\ No newline at end of file
+        self.assertCountEqual(["breadcrumbs", "main_menu", "sub_menu"], self.menu.get_data("doesn't matter"))
+
+    def test_dynamic_url(self):
+        """ Для URL, вложенного в URL пункта меню, используется пункт с самым длинным совпадающим префиксом """
+        breadcrumbs = [
+            {"url": "/contracts/", "alias": "Система ввода договоров"},
+            {"alias": "Список договоров"}
+        ]
+        self.assertCountEqual(breadcrumbs, self.menu.get_breadcrumbs("/contracts/show/123/"))
+        self.assertEqual("/contracts/", self.menu.resolve("/contracts/123/").url)
+        self.assertEqual(2, len(self.menu.get_sub_menu("/contracts/123/").get_full()))
+        self.assertEqual([True, False, False], [item["active"] for item in self.menu.get_full("/contracts/show/123/")])
+
+    def test_append_resets_compiled_menu(self):
+        """ После добавления пунктов меню компилируется заново """
+        self.menu.get_data("/profile/")
+        self.menu.items[1].append([MenuItem("/profile/sessions/", "Сессии")])
+        self.assertEqual("/profile/sessions/", self.menu.resolve("/profile/sessions/1/").url)
+
+
+class SearchIndexTest(TestCase):
+    """ Тестирование поискового индекса """
+
+    def setUp(self):
+        self.pool = getattr(SearchIndexMapper, "pool", None)
+        SearchIndexMapper.pool = ConnectionPool(RecordingConnection)
+
+    def tearDown(self):
+        SearchIndexMapper.pool = self.pool
+
+    def test_tokens(self):
+        """ Значение разбивается на триграммы без учета регистра """
+        self.assertEqual({"ива", "ван", "ано", "нов"}, SearchIndex.tokens("Иванов"))
+        self.assertEqual(set(), SearchIndex.tokens("Ив"))
+        self.assertEqual(set(), SearchIndex.tokens(None))
+
+    def test_search_not_indexed_field(self):
+        """ Для неиндексируемых свойств и коротких запросов индекс не используется """
+        index = SearchIndex("Users", ["name"])
+        self.assertIsNone(index.search("email", "ivanov"))
+        self.assertIsNone(index.search("name", "iv"))
+
+    def queries(self) -> list:
+        db = SearchIndexMapper.pool.db
+        return [
+            (sql, params) for sql, params in zip(db.queries, db.params) if sql not in ("START TRANSACTION", "COMMIT")
+        ]
+
+    def test_index_many_batches_inserts(self):
+        """ Записи индекса вставляются пакетами по batch_size строк; значения передаются параметрами запроса """
+        index = SearchIndex("Users", ["name"])
+        index.batch_size = 4
+        index.index_many([(1, {"name": "Иванов"}), (2, {"name": "O'Neil"})])
+        queries = self.queries()
+        self.assertEqual(
+            ("DELETE FROM `SearchIndex` WHERE `Collection` = %s AND `RowID` IN (%s, %s)", ["Users", "1", "2"]),
+            queries[0]
+        )
+        self.assertEqual(2, len(queries[1:]))
+        self.assertEqual(4 * 4, queries[1][0].count("%s"))
+        self.assertEqual(["Users", "name", "1", "ано"], queries[1][1][:4])
+        self.assertEqual(["Users", "name", "2", "o'n"], queries[2][1][-4:])
+
+    def test_search_intersects_in_database(self):
+        """ Пересечение триграмм выполняется одним запросом с ограничением на количество кандидатов """
+        index = SearchIndex("Users", ["name"])
+        SearchIndexMapper.pool.db.result = [("1",), ("5",)]
+        self.assertEqual({"1", "5"}, index.search("name", "ivan"))
+        (sql, params), = self.queries()
+        self.assertIn("HAVING COUNT(DISTINCT `Token`) = %s LIMIT %s", sql)
+        self.assertEqual(["Users", "name", "iva", "van", 2, index.max_candidates + 1], params)
+
+        index.max_candidates = 1
+        self.assertIsNone(index.search("name", "ivan"))
+
+    def test_updated_keys(self):
+        """ Строки, измененные update коллекции, переиндексируются по ключам порциями без загрузки сущностей """
+        table = MemoryTable.make([{"id": 1, "name": "Иванов"}, {"id": 2, "name": "Петров"}, {"id": 3, "name": "Сидоров"}])
+        index = SearchIndex("Memory", ["name"], lambda: table)
+        index.batch_size = 2
+        selects = []
+        generate_rows = table.generate_rows
+        table.generate_rows = lambda fields, bounds=None, params=None: selects.append((fields, bounds)) or \
+            generate_rows(fields, bounds, params)
+        index.written([], [], [1, 2, 3])
+        self.assertEqual([(["id", "name"], {"id": ("in", [1, 2])}), (["id", "name"], {"id": ("in", [3])})], selects)
+        inserted = [params for sql, params in self.queries() if sql.startswith("INSERT")]
+        self.assertEqual({"1", "2", "3"}, {params[2] for params in inserted})
+
+
+class MemoryConnection(object):
+    """ Соединение, принимающее любые запросы (для транзакций таблицы в памяти) """
+    def __init__(self):
+        self.db = self
+
+    def execute_raw(self, sql, params=None):
+        pass
+
+
+class RecordingConnection(MemoryConnection):
+    """ Соединение, запоминающее выполненные запросы и их параметры """
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+        self.params = []
+        self.result = []
+
+    def execute_raw(self, sql, params=None):
+        self.queries.append(sql)
+        self.params.append(params)
+        return self.result
+
+
+class MemoryEntity(object):
+    """ Сущность таблицы в памяти """
+    def __init__(self, table, data):
+        self.table = table
+        self.data = dict(data)
+        self.primary = self
+        self.mapper = table.mapper
+
+    def get_value(self, deep=False):
+        return self.data["id"]
+
+    def load_from_array(self, data, consider_as_unchanged=False):
+        self.data.update(data)
+        return self
+
+    def stringify(self, properties):
+        return {p: "" if self.data.get(p) is None else str(self.data.get(p)) for p in properties}
+
+    def save(self):
+        self.table.storage[self.data["id"]] = dict(self.data)
+        return self
+
+    def __getattr__(self, item):
+        return self.data.get(item)
+
+
+class MemoryTable(TableView):
+    """ Таблица, хранящая записи в памяти, вместо базы данных (первичный ключ id - целое число) """
+
+    class mapper(object):
+        class primary(object):
+            @staticmethod
+            def name():
+                return "id"
+
+            @staticmethod
+            def exists():
+                return True
+
+        class column(object):
+            def __init__(self, db_name=None, collection=None):
+                self.db_name = db_name
+                self.collection = collection
+
+        columns = {"id": column("ID"), "name": column("Name"), "tags": column()}
+        pool = ConnectionPool(RecordingConnection)
+
+        @staticmethod
+        def get_collection_name():
+            return "Memory"
+
+        @classmethod
+        def get_properties(cls):
+            return list(cls.columns)
+
+        @classmethod
+        def get_property(cls, name):
+            return cls.columns[name]
+
+    @classmethod
+    def make(cls, rows: list):
+        table = cls.__new__(cls)
+        table._orders, table.boundaries = {}, {}
+        table.storage = {row["id"]: dict(row) for row in rows}
+        return table
+
+    def get_new_item(self, data=None):
+        return MemoryEntity(self, data or {})
+
+    def _select(self, bounds):
+        # Как и MySQL, сравниваем целочисленный ключ со строковыми значениями из запроса
+        keys = bounds["id"] if bounds else None
+        keys = {str(key) for key in (keys[1] if isinstance(keys, tuple) else [keys])} if bounds else None
+        return [row for key, row in self.storage.items() if keys is None or str(key) in keys]
+
+    def get_items(self, bounds=None, params=None, prefetch_related=None):
+        return [MemoryEntity(self, row) for row in self._select(bounds)]
+
+    def generate_rows(self, fields, bounds=None, params=None):
+        return ({field: row.get(field) for field in fields} for row in self._select(bounds))
+
+    def _delete_keys(self, keys):
+        for key in keys:
+            self.storage.pop(key, None)
+
+
+class TableViewBulkTest(TestCase):
+    """ Тестирование пакетных операций TableView """
+
+    def setUp(self):
+        self.table = MemoryTable.make([{"id": 1, "name": "a"}, {"id": 2, "name": "b"}])
+
+    def test_update_many(self):
+        """ Ключи из запроса (строки) сопоставляются с целочисленными ключами таблицы """
+        results = self.table.update_many({"rows": [{"row_id": "1", "name": "c"}, {"row_id": "3", "name": "d"}]})
+        self.assertEqual(["updated", "not_found"], [result["result"] for result in results])
+        self.assertEqual("c", self.table.storage[1]["name"])
+
+    def test_delete_many(self):
+        """ Удаленные записи отмечаются как deleted, отсутствующие - как not_found """
+        results = self.table.delete_many({"row_id": ["2", "5"]})
+        self.assertEqual([{"row_id": "2", "result": "deleted"}, {"row_id": "5", "result": "not_found"}], results)
+        self.assertEqual([1], list(self.table.storage))
+
+    def test_create_many(self):
+        """ Существующие записи не создаются повторно """
+        results = self.table.create_many({"rows": [{"id": 1, "name": "x"}, {"id": 3, "name": "y"}]})
+        self.assertEqual(["exists", "created"], [result["result"] for result in results])
+        self.assertEqual("a", self.table.storage[1]["name"])
+        self.assertEqual("y", self.table.storage[3]["name"])
+
+    def test_create_many_database_error(self):
+        """ Ошибка базы данных при сохранении строки откатывает только эту строку """
+        class FailingEntity(MemoryEntity):
+            def save(self):
+                if self.data["name"] == "bad":
+                    raise RuntimeError("Duplicate entry")
+                return super().save()
+
+        self.table.get_new_item = lambda data=None: FailingEntity(self.table, data or {})
+        db = MemoryTable.mapper.pool.db
+        db.queries = []
+        results = self.table.create_many({"rows": [{"id": 3, "name": "bad"}, {"id": 4, "name": "good"}]})
+        self.assertEqual([("error", "Duplicate entry"), ("created", None)],
+                         [(result["result"], result.get("message")) for result in results])
+        self.assertEqual([1, 2, 4], sorted(self.table.storage))
+        self.assertEqual(["START TRANSACTION", "SAVEPOINT bulk_row", "ROLLBACK TO SAVEPOINT bulk_row",
+                          "SAVEPOINT bulk_row", "RELEASE SAVEPOINT bulk_row", "COMMIT"], db.queries)
+
+
+class TableViewFacetTest(TestCase):
+    """ Тестирование фасетов TableView """
+
+    def setUp(self):
+        self.table = MemoryTable.make([])
+        self.db = MemoryTable.mapper.pool.db
+        self.db.queries, self.db.params, self.db.result = [], [], [("b", 1), (None, 2), ("a", 3)]
+        TableView.facets_cache.invalidate_tag(MemoryTable.mapper)
+
+    def test_facet_group_by(self):
+        """ Количество записей подсчитывается запросом GROUP BY с ограничениями таблицы """
+        self.table.boundaries = {"id": ("in", [1, 2]), "name": "x"}
+        facet = self.table.facet("name")
+        self.assertEqual([None, "a", "b"], [value["value"] for value in facet])
+        self.assertEqual([2, 3, 1], [value["count"] for value in facet])
+        self.assertEqual(["SELECT `Name`, COUNT(*) FROM `Memory` WHERE `ID` IN (%s, %s) GROUP BY `Name`"], self.db.queries)
+        self.assertEqual([[1, 2]], self.db.params)
+
+    def test_facet_cache_per_contour(self):
+        """ Фасеты разных контуров кэшируются отдельно """
+        self.table.facet("name")
+        with Application.using_contour(Contours.PRODUCTION):
+            self.table.facet("name")
+        self.table.facet("name")
+        self.assertEqual(2, len(self.db.queries))
+
+    def test_facet_query_unsupported_bounds(self):
+        """ Ограничения по свойствам без колонки не переводятся в SQL """
+        self.assertIsNone(self.table._facet_query("name", {"tags": "x"}))
+        self.assertIsNone(self.table._facet_query("tags", {}))
+        self.assertIsNone(self.table._facet_query("name", {"account.login": "x"}))
+
+    def test_facet_query_params(self):
+        """ Значения ограничений передаются параметрами запроса """
+        self.assertEqual(
+            ("SELECT `Name`, COUNT(*) FROM `Memory` WHERE `ID` = %s AND `Name` LIKE %s GROUP BY `Name`", ["1'", "%a%"]),
+            self.table._facet_query("name", {"id": "1'", "name": ("match", "%a%")})
+        )
+
+    def test_facet_query_without_table_name(self):
+        """ Если имя таблицы маппера не задано, подсчет не переходит молча к выборке всех строк """
+        get_collection_name = MemoryTable.mapper.get_collection_name
+        MemoryTable.mapper.get_collection_name = staticmethod(lambda: None)
+        try:
+            self.assertRaises(ValueError, self.table.facet, "name")
+        finally:
+            MemoryTable.mapper.get_collection_name = get_collection_name
+
+
+class TableViewFetchOneTest(TestCase):
+    """ Тестирование выборки записи для формы редактирования """
+
+    def test_fetch_column_properties(self):
+        """ Выбираются только свойства, хранящиеся в колонках таблицы; значения форматируются через stringify """
+        table = MemoryTable.make([{"id": 1, "name": None, "tags": ["x"]}])
+        self.assertEqual({"id": "1", "name": "", "row_id": 1}, table.fetch_one({"row_id": "1"}))
+
+    def test_fetch_links(self):
+        """ Ссылка возвращается значением внешнего ключа без загрузки связанной сущности,
+        связи fetch_related загружаются для выбранной записи без ее повторной выборки
+        """
+        class Group(MemoryEntity, EntityModel):
+            pass
+
+        class Groups(MemoryTable):
+            def get_new_item(self, data=None):
+                return Group(self, data or {})
+
+            def get_items(self, bounds=None, params=None, prefetch_related=None):
+                return [Group(self, row) for row in self._select(bounds)]
+
+        class LinkedEntity(MemoryEntity):
+            def __getattr__(self, item):
+                # Чтение ссылки, в которой еще хранится внешний ключ, означало бы загрузку связанной сущности
+                if item == "group" and not isinstance(self.data.get(item), Group):
+                    raise AssertionError("Link was loaded")
+                return super().__getattr__(item)
+
+            def stringify(self, properties):
+                return super().stringify([p for p in properties if p != "group"])
+
+        class LinkedTable(MemoryTable):
+            class mapper(MemoryTable.mapper):
+                columns = dict(MemoryTable.mapper.columns, group=MemoryTable.mapper.column("GroupID", Groups))
+
+            def get_new_item(self, data=None):
+                return LinkedEntity(self, data or {})
+
+        groups = Groups.make([{"id": 5, "name": "admins"}])
+        table = LinkedTable.make([{"id": 1, "name": "a", "group": 5}])
+        selects = []
+        generate_rows = table.generate_rows
+        table.generate_rows = lambda fields, bounds=None, params=None: selects.append(bounds) or \
+            generate_rows(fields, bounds, params)
+        self.assertEqual({"id": "1", "name": "a", "group": 5, "row_id": 1}, table.fetch_one({"row_id": "1"}))
+
+        data = table.fetch_one({"row_id": "1"}, relations=[Prefetch("group", lambda: groups)])
+        self.assertEqual({"id": "5", "name": "admins", "tags": ""}, data["group"])
+        self.assertEqual([{"id": "1"}, {"id": "1"}], selects)
+
+
+class TableViewFilterTest(TestCase):
+    """ Тестирование фильтров TableView """
+
+    def test_autocomplete_escapes_like(self):
+        """ Символы шаблона LIKE во введенном значении ищутся как обычные символы """
+        table = MemoryTable.make([])
+        table.apply_filters({"filter_autocomplete": {"name": "50%_a"}})
+        self.assertEqual({"name": ("match", "%50\\%\\_a%")}, table.boundaries)
+
+
+class TableViewSeekTest(TestCase):
+    """ Тестирование постраничной навигации по курсору """
+
+    def setUp(self):
+        self.table = MemoryTable.make([])
+
+    def test_seek_boundaries(self):
+        """ Строки после курсора выбираются по колонке сортировки и первичному ключу """
+        self.assertEqual(
+            {"or": [{"name": ("gt", "a")}, {"name": "a", "id": ("gt", 5)}]},
+            self.table._seek_boundaries("name", "ASC", "a", 5)
+        )
+        self.assertEqual({"id": ("lt", 5)}, self.table._seek_boundaries(None, "DESC", None, 5))
+
+    def test_seek_boundaries_null(self):
+        """ NULL в колонке сортировки не сравнивается: такие строки идут первыми при ASC и последними при DESC """
+        self.assertEqual(
+            {"or": [{"name": None, "id": ("gt", 5)}, {"name": ("ne", None)}]},
+            self.table._seek_boundaries("name", "ASC", None, 5)
+        )
+        self.assertEqual({"name": None, "id": ("lt", 5)}, self.table._seek_boundaries("name", "DESC", None, 5))
+        self.assertEqual(
+            {"or": [{"name": ("lt", "a")}, {"name": "a", "id": ("lt", 5)}, {"name": None}]},
+            self.table._seek_boundaries("name", "DESC", "a", 5)
+        )
+
+    def test_cursor_page(self):
+        """ Номер страницы передается в курсоре; поврежденный курсор означает первую страницу """
+        cursor = self.table._encode_cursor(None, MemoryEntity(self.table, {"id": 7}), False, 3)
+        self.assertEqual((False, (None, 7), 3), self.table._decode_cursor(None, cursor))
+        self.assertEqual((False, None, 1), self.table._decode_cursor(None, "broken"))
+
+    def test_pager_without_count(self):
+        """ Пейджер навигации по курсору не считает записи: последней известной страницей считается следующая """
+        pager = LinearPager.for_cursor(3, 30, has_next=True)
+        self.assertEqual((60, 30), (pager.offset, pager.limit))
+        self.assertEqual([1, 2, 3, 4], pager.represent()["values"])
+        self.assertEqual(3, LinearPager.for_cursor(3, 30, has_next=False).represent()["max_value"])